@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Compare allocations, memory and time of showing a decrypted entry, between
+SecretEntry and the original way (decoded string, split into lines and
+parsed with the string methods).
+
+    python benchmarks/bench_entry.py [NOTES_LINES ...]
+
+Selection is everything from the gpg output to the texts of the password,
+user, url and notes widgets. CPython doesn't count allocations, so
+allocated_blocks are the memory blocks which show up between bytecodes
+(objects reused from free lists are not counted by either of them).
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gtkpass  # noqa: E402
+
+FIELDS = ('password', 'user', 'url', 'notes')
+
+
+def make_entry(notes_lines):
+    "Return gpg output of the entry with given number of notes lines"
+    notes = ''.join(f'line {x} of the notes, 1234-5678\n'
+                    for x in range(notes_lines))
+    return bytearray(f'S3cr3t-passw0rd\nuser: alice@example.com\n'
+                     f'url: https://example.com/login\notp: 123456\n'
+                     f'notes: {notes}'.encode())
+
+
+def legacy_parse(data):
+    fields = {'password': '', 'user': '', 'url': '', 'notes': ''}
+    output = data.split('\n')
+
+    for count, line in enumerate(output):
+        if count == 0:
+            fields['password'] = line.strip()
+            continue
+        if (line.lower().startswith('user:') or
+                line.lower().startswith('username:')):
+            fields['user'] = line.split(':')[1].strip()
+            continue
+        if line.lower().startswith('url:'):
+            fields['url'] = ':'.join(line.split(':')[1:]).strip()
+            continue
+        if line.lower().startswith('notes:'):
+            fields['notes'] = "\n".join(output[count:])[6:].strip()
+            break
+    return fields
+
+
+def select_legacy(output, show):
+    # subprocess reads the output into bytes, and decodes it
+    fields = legacy_parse(bytes(output).decode('utf-8'))
+    for name in FIELDS:
+        show(fields[name])
+
+
+def select_entry(output, show):
+    # output is read straight into the buffer
+    entry = gtkpass.SecretEntry(bytearray(output))
+    for name in FIELDS:
+        show(entry[name])
+    # deselected
+    entry.wipe()
+
+
+def count_blocks(func, *args):
+    "Return number of memory blocks allocated by func between bytecodes"
+    total = 0
+    last = None
+
+    def trace(frame, event, arg):
+        nonlocal total, last
+        blocks = sys.getallocatedblocks()
+        if last is not None and blocks > last:
+            total += blocks - last
+        frame.f_trace_opcodes = True
+        last = sys.getallocatedblocks()
+        return trace
+
+    sys.settrace(trace)
+    try:
+        func(*args)
+    finally:
+        sys.settrace(None)
+    return total
+
+
+def measure(select, output, repeat=10000):
+    def show(text):
+        pass
+
+    # warm up caches (compiled patterns and such)
+    select(output, show)
+    blocks = min(count_blocks(select, output, show) for _ in range(5))
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    select(output, show)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        select(output, show)
+    elapsed = (time.perf_counter() - start) / repeat
+    return {'allocated_blocks': blocks,
+            'peak_bytes': peak,
+            'select_us': round(elapsed * 1e6, 2)}
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1, 100]
+    results = []
+    for size in sizes:
+        output = make_entry(size)
+        results.append({'notes_lines': size,
+                        'entry_bytes': len(output),
+                        'legacy': measure(select_legacy, output),
+                        'secret_entry': measure(select_entry, output)})
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
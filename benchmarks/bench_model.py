@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Compare memory and time of the Tree/Leaf model against the original one
+(plain objects with full paths, sorting on every access).
+
+    python benchmarks/bench_model.py [SIZE ...]
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gtkpass  # noqa: E402
+
+
+class LegacyLeaf:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+
+class LegacyTree:
+    def __init__(self, name=None, path=None):
+        self.name = name
+        self.children = []
+        self.path = path
+
+    @property
+    def sorted_children(self):
+        files = {}
+        dirs = {}
+        for i in self.children:
+            if isinstance(i, LegacyLeaf):
+                files[i.name] = i
+            else:
+                dirs[i.name] = i
+        return ([dirs[x] for x in sorted(dirs)] +
+                [files[x] for x in sorted(files)])
+
+
+def layout(size, fanout=20):
+    """Yield (directory path, entry names) for a store with size entries,
+    with fanout entries per directory"""
+    for num in range(0, size, fanout):
+        dirname = f'team{num // (fanout * fanout)}/group{num // fanout}'
+        yield dirname, [f'entry{x}.example.com'
+                        for x in range(num, min(num + fanout, size))]
+
+
+def build_legacy(size):
+    root = LegacyTree()
+    dirs = {'': root}
+    for dirname, names in layout(size):
+        parent = ''
+        for part in dirname.split('/'):
+            path = f'{parent}/{part}' if parent else part
+            if path not in dirs:
+                dirs[path] = LegacyTree(part, path)
+                dirs[parent].children.append(dirs[path])
+            parent = path
+        for name in names:
+            dirs[dirname].children.append(LegacyLeaf(name,
+                                                     f'{dirname}/{name}'))
+    return root
+
+
+def build_compact(size):
+    root = gtkpass.Tree()
+    dirs = {'': root}
+    for dirname, names in layout(size):
+        parent = ''
+        for part in dirname.split('/'):
+            path = f'{parent}/{part}' if parent else part
+            if path not in dirs:
+                dirs[path] = gtkpass.Tree(part)
+                dirs[parent].add_child(dirs[path])
+            parent = path
+        for name in names:
+            dirs[dirname].add_child(gtkpass.Leaf(name))
+    return root
+
+
+def traverse(model):
+    count = 0
+    for obj in model.sorted_children:
+        count += 1
+        if hasattr(obj, 'children'):
+            count += traverse(obj)
+    return count
+
+
+def measure(build, size, repeat=3):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = build(size)
+    build_time = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        traverse(model)
+    traverse_time = (time.perf_counter() - start) / repeat
+    return {'memory_bytes': memory,
+            'build_s': round(build_time, 4),
+            'traverse_s': round(traverse_time, 4)}
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000]
+    results = []
+    for size in sizes:
+        results.append({'entries': size,
+                        'legacy': measure(build_legacy, size),
+                        'compact': measure(build_compact, size)})
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
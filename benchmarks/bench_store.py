@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Benchmark loading of the store, populating the tree store and searching, on
+a synthetic password store with empty .gpg files.
+
+It needs a display, which can be provided by Xvfb or the broadway backend:
+
+    xvfb-run python benchmarks/bench_store.py --entries 50000
+    broadwayd :5 & GDK_BACKEND=broadway BROADWAY_DISPLAY=:5 \\
+        python benchmarks/bench_store.py
+
+Results are written as JSON to stdout or to the --output file.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+
+def make_store(path, entries, depth, fanout):
+    """Create store with given number of entries, spread evenly over the
+    directories fanout wide and depth deep"""
+    dirs = ['']
+    for _ in range(depth):
+        dirs = [os.path.join(parent, f'dir{num}')
+                for parent in dirs for num in range(fanout)]
+    for dirname in dirs:
+        os.makedirs(os.path.join(path, dirname), exist_ok=True)
+    with open(os.path.join(path, '.gpg-id'), 'w') as fobj:
+        fobj.write('benchmark@example.com\n')
+    for num in range(entries):
+        dirname = dirs[num % len(dirs)]
+        name = f'site{num}.example.com.gpg' if num % 3 else f'user{num}.gpg'
+        open(os.path.join(path, dirname, name), 'w').close()
+
+
+def stats(times):
+    return {'runs': len(times),
+            'min_s': round(min(times), 6),
+            'median_s': round(statistics.median(times), 6),
+            'max_s': round(max(times), 6)}
+
+
+def timeit(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return stats(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-e', '--entries', type=int, default=10000)
+    parser.add_argument('-d', '--depth', type=int, default=2)
+    parser.add_argument('-f', '--fanout', type=int, default=10)
+    parser.add_argument('-r', '--runs', type=int, default=5)
+    parser.add_argument('-q', '--query', action='append',
+                        help='query to search for, can be repeated')
+    parser.add_argument('-o', '--output', help='write results to the file')
+    args = parser.parse_args()
+    queries = args.query or ['s', 'site', 'site12', 'user1', 'nomatch']
+
+    workdir = tempfile.TemporaryDirectory(prefix='gtkpass-bench-')
+    home = workdir.name
+    # isolate from the real store and configuration, before gtkpass
+    # picks them up
+    os.environ['HOME'] = home
+    os.environ['XDG_CONFIG_HOME'] = os.path.join(home, '.config')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(home, '.cache')
+    os.makedirs(os.environ['XDG_CONFIG_HOME'])
+    with open(os.path.join(os.environ['XDG_CONFIG_HOME'], 'gtkpass.yaml'),
+              'w') as fobj:
+        fobj.write('tree_snapshot: false\nwatch_store: false\n')
+    make_store(os.path.join(home, '.password-store'), args.entries,
+               args.depth, args.fanout)
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+    import gtkpass
+    from gi.repository import Gtk
+
+    if not Gtk.init_check(sys.argv)[0]:
+        sys.exit('Cannot open display, run it under xvfb-run or broadway.')
+
+    results = {}
+    store = gtkpass.PassStore()
+    results['gather_pass_tree'] = timeit(store.gather_pass_tree, args.runs)
+
+    app = gtkpass.GTKPass()
+    # don't wait for the first frame to read the store
+    app.populate()
+    while app.loading or Gtk.events_pending():
+        Gtk.main_iteration_do(False)
+
+    def add_nodes():
+        app.tree_store.clear()
+        app._rows.clear()
+        app.add_nodes(app.passs.data, None)
+    results['add_nodes'] = timeit(add_nodes, args.runs)
+
+    def search(query):
+        app.search.set_text(query)
+        # skip the debounce delay, and wait until all the changes are in
+        app.scheduler.run()
+        while app.scheduler.pending or Gtk.events_pending():
+            Gtk.main_iteration_do(False)
+
+    results['refresh'] = {}
+    for query in queries:
+        times = []
+        for _ in range(args.runs):
+            search('')
+            start = time.perf_counter()
+            search(query)
+            times.append(time.perf_counter() - start)
+        results['refresh'][query] = stats(times)
+
+    report = {'python': platform.python_version(),
+              'gtk': '.'.join(str(x) for x in (Gtk.get_major_version(),
+                                               Gtk.get_minor_version(),
+                                               Gtk.get_micro_version())),
+              'params': {'entries': args.entries, 'depth': args.depth,
+                         'fanout': args.fanout, 'runs': args.runs},
+              'results': results}
+
+    app.destroy()
+    workdir.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,349 @@
 #!/usr/bin/env python
+import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import re
 import signal
 import shutil
+import socket
 import subprocess
+import sys
+import threading
+import time
 
-import gi
+# startup phases, as (name, time it has finished) pairs
+_STARTUP = [('start', time.perf_counter())]
+
+ENTRY_FIELDS = ('password', 'user', 'url', 'notes')
+
+
+def _socket_path():
+    runtime = os.getenv('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'gtkpass.sock')
+    return os.path.join('/tmp', f'gtkpass-{os.getuid()}.sock')
+
+
+def _client(args):
+    "Send request to the daemon, and print the response"
+    if args.search is not None:
+        request = {'cmd': 'search', 'query': args.search, 'limit': args.limit}
+    elif args.lookup is not None:
+        request = {'cmd': 'lookup', 'path': args.lookup, 'field': args.field}
+    else:
+        request = {'cmd': 'copy', 'path': args.copy, 'field': args.field}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as fobj:
+            response = json.loads(fobj.readline())
+    except (OSError, ValueError) as exc:
+        sys.exit(f'Error: cannot talk to the daemon on {args.socket}: {exc}')
+    finally:
+        sock.close()
+
+    if not response['ok']:
+        sys.exit(f'Error: {response["error"]}')
+    if 'results' in response:
+        for path in response['results']:
+            print(path)
+    elif 'value' in response:
+        print(response['value'])
+
+
+def _is_client(args):
+    "Return whether the command line asks the daemon for something"
+    return any(x is not None for x in (args.search, args.lookup, args.copy))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='GUI for pass')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report time spent in startup phases and exit')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run without window, serving requests on the '
+                        'socket')
+    parser.add_argument('--socket', default=_socket_path(),
+                        help='daemon socket path (default: %(default)s)')
+    client = parser.add_mutually_exclusive_group()
+    client.add_argument('--search', metavar='QUERY',
+                        help='print entries matching the query')
+    client.add_argument('--lookup', metavar='PATH',
+                        help='print field of the entry')
+    client.add_argument('--copy', metavar='PATH',
+                        help='copy field of the entry to the clipboard')
+    parser.add_argument('--field', default='password',
+                        choices=ENTRY_FIELDS,
+                        help='entry field for --lookup and --copy')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='maximum number of --search results')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    _ARGS = _parse_args()
+    if _is_client(_ARGS):
+        # launchers only talk to the daemon, without importing (and so
+        # initialising) GTK at all
+        _client(_ARGS)
+        sys.exit()
+
+import gi  # noqa: E402
 gi.require_version('Gdk', '3.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('Pango', '1.0')
 from gi.repository import GLib  # noqa: E402
 from gi.repository import Gdk  # noqa: E402
+from gi.repository import Gio  # noqa: E402
+from gi.repository import GObject  # noqa: E402
 from gi.repository import Gtk  # noqa: E402
 from gi.repository import Pango  # noqa: E402
-import yaml  # noqa: E402
+
+_STARTUP.append(('imports', time.perf_counter()))
+
+# yaml, GPGME bindings and parsers of the imported files are imported only
+# when they are needed
+gpgme = None
 
 
 XDG_CONF_DIR = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
+XDG_CACHE_DIR = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+SNAPSHOT_VERSION = 1
 
 
-class GTKPass(Gtk.Window):
+class Metrics:
+    """Latency histograms and counters of the hot paths. Only the last SIZE
+    durations of every operation are kept, in the ring buffer, so memory use
+    is bounded and percentiles follow recent behaviour. While disabled, timed
+    functions cost just a single attribute check."""
+    SIZE = 1024
+    PERCENTILES = (50, 95, 99)
 
     def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._counters = collections.Counter()
+
+    def record(self, name, seconds):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = collections.deque(
+                    maxlen=self.SIZE)
+            samples.append(seconds)
+            self._counters[name] += 1
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += value
+
+    def timed(self, name):
+        "Decorator recording duration of every call of the function as name"
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def report(self):
+        """Return dict with all the counters, and percentiles and maximum (in
+        ms) of the recent durations of every operation"""
+        with self._lock:
+            samples = {x: sorted(y) for x, y in self._samples.items()}
+            counters = dict(self._counters)
+        latency = {}
+        for name, values in sorted(samples.items()):
+            stats = {'samples': len(values)}
+            for pct in self.PERCENTILES:
+                # nearest rank
+                rank = min(len(values) - 1, len(values) * pct // 100)
+                stats[f'p{pct}'] = round(values[rank] * 1000, 3)
+            stats['max'] = round(values[-1] * 1000, 3)
+            latency[name] = stats
+        return {'time': time.time(), 'counters': counters,
+                'latency': latency}
+
+    def dump(self):
+        """Write the report into the cache directory, as the SIGUSR1
+        handler"""
+        path = os.path.join(XDG_CACHE_DIR, 'gtkpass',
+                            f'metrics-{os.getpid()}.json')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as fobj:
+                json.dump(self.report(), fobj, indent=1)
+            os.replace(path + '.tmp', path)
+            print(f'Metrics written to {path}', file=sys.stderr)
+        except OSError as e:
+            print('Warning: There was an error on saving metrics:', e)
+        return True
+
+
+METRICS = Metrics()
+
+
+class GTKPass(Gtk.Window):
+
+    def __init__(self, profile=False):
         Gtk.Window.__init__(self, title="GTKPass")
 
         self.passs = PassStore()
-        self.passs.gather_pass_tree()
+        _mark('config')
+        if self.passs.metadata:
+            self.passs.metadata.on_update = self.on_metadata_updated
         self.conf = self.passs.conf
+        self.profile = profile
+        self.populated = False
+        self.loading = False
         self._border = 5
         self._expand = False
         self._selected = None
+        self._rows = {}
+        self._placeholders = {}
+        self._hidden = set()
+        self._bold = set()
+        self._fuzzy = self.conf.get('search_mode') == 'fuzzy'
+        self._results = []
+        self._neighbours = []
+        self._entry = None  # path and SecretEntry being shown
+        self._decrypting = None
+        self._copy_request = None
+        self._prefetch = collections.deque()
+        self._prefetching = 0  # number of directories being read
+        # every store is synchronized on its own
+        self.git = {mount: GitSync(path)
+                    for mount, path in self.passs.stores.items()}
+        self._git_pending = set()
+        self._git_errors = []
         self.make_ui()
+        _mark('window')
+        # store is read only after the window is shown
+        self._draw_handler = self.connect_after('draw', self.on_first_draw)
+
+        # drop decrypted secrets whenever window is hidden, minimized or the
+        # session is locked
+        self.connect('hide', lambda _: self.passs.cache.clear())
+        self.connect('window-state-event', self.on_window_state_event)
+        self._watch_screensaver()
+
+    def on_first_draw(self, widget, context):
+        self.disconnect(self._draw_handler)
+        _mark('first paint')
+        # low priority, so that the frame gets presented first
+        GLib.idle_add(self.populate, priority=GLib.PRIORITY_LOW)
+        return False
+
+    def populate(self):
+        "Read the store (or its snapshot), and fill the tree with it"
+        if self.populated:
+            return False
+        self.populated = True
+
+        up_to_date = self.passs.load_snapshot()
+        if up_to_date is None:
+            # there is nothing to show, so show directories as they are read
+            self.loading = True
+            self.passs.scan_async(self.on_scan_batch, self.on_scanned)
+            return False
+        _mark('tree')
+
+        self.detach_view()
+        self.add_nodes(self.passs.data, None)
+        self.attach_view()
+        self._finish_populate(up_to_date)
+        return False
+
+    @METRICS.timed('scan_batch')
+    def on_scan_batch(self, items):
+        "Attach directories read so far, and add their rows"
+        for tree, mtime, children in items:
+            self.passs.attach(tree, mtime, children)
+            if tree is self.passs.data:
+                parent = None
+            elif tree in self._rows:
+                parent = self._rows[tree]
+            else:
+                continue
+            # all the children of a directory come at once, so they can be
+            # just appended in order
+            for obj in tree.sorted_children:
+                child = self.tree_store.append(parent, self._make_row(obj))
+                self._rows[obj] = child
+                if isinstance(obj, Tree) and not obj.loaded:
+                    # placeholder of lazily loaded directory
+                    self._add_subtree(obj, child)
+        return False
+
+    def on_scanned(self, data):
+        self.loading = False
+        if data is not self.passs.data:
+            return False
+        _mark('tree')
+        self.passs.save_snapshot()
+        self._finish_populate(True)
+        return False
+
+    def _finish_populate(self, up_to_date):
+        self._set_busy(False)
+        _mark('populate')
+
+        if self.conf.get('watch_store', True):
+            self.watcher = StoreWatcher(self.passs, self.on_store_changed)
+            self.watcher.watch(self.passs.data)
+
+        if up_to_date is False:
+            # show what we have, and sync it with the store in the background
+            self.passs.rescan_async(self.on_rescanned)
+
+        if self._fuzzy:
+            GLib.idle_add(self._prepare_index)
+
+        if self.passs.lazy:
+            self._prefetch.extend(x for x in self.passs.data.children
+                                  if isinstance(x, Tree))
+            self._prefetch_next()
+
+        self.refresh()
+
+        if self.profile:
+            _report_startup()
+            self.close()
+
+    def _watch_screensaver(self):
+        try:
+            bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        except GLib.Error:
+            return
+        for iface in ('org.freedesktop.ScreenSaver', 'org.gnome.ScreenSaver'):
+            bus.signal_subscribe(None, iface, 'ActiveChanged', None, None,
+                                 Gio.DBusSignalFlags.NONE,
+                                 self.on_screensaver_changed)
+
+    def on_screensaver_changed(self, conn, sender, path, iface, signal_name,
+                               params):
+        if params.unpack()[0]:
+            self.passs.cache.clear()
+
+    def on_window_state_event(self, widget, event):
+        if event.new_window_state & Gdk.WindowState.ICONIFIED:
+            self.passs.cache.clear()
 
     def make_ui(self):
         if (self.conf.get('width') and self.conf.get('height')):
@@ -38,10 +352,10 @@ class GTKPass(Gtk.Window):
 
         self.tree_store = Gtk.TreeStore(bool, str, Pango.Weight, str, str,
                                         bool)
-        self.add_nodes(self.passs.data, None)
 
         # clipboard
-        self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        self.clipboard = ClipboardManager(self.conf.get('clipboard_timeout',
+                                                        45))
 
         # attach keyboard events
         self.connect("key-press-event", self.on_key_press_event)
@@ -69,8 +383,23 @@ class GTKPass(Gtk.Window):
         # search box
         self.search = Gtk.SearchEntry()
         self.search.set_placeholder_text("Search password")
-        self.search.connect("changed", self.refresh)
-        lbox.pack_start(child=self.search, expand=False, fill=False, padding=0)
+        self.scheduler = SearchScheduler(self,
+                                         self.conf.get('search_delay', 150))
+        self.search.connect("changed", lambda _: self.scheduler.schedule())
+
+        # toggle between filtered tree and flat list of ranked results
+        self.flat = Gtk.ToggleButton()
+        self.flat.set_image(Gtk.Image.new_from_icon_name(
+            'view-list-symbolic', Gtk.IconSize.BUTTON))
+        self.flat.set_tooltip_text('Show results as a ranked list')
+        self.flat.set_active(self.conf.get('flat_results', False))
+        self.flat.connect('toggled', self.on_flat_toggled)
+
+        sbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
+                       spacing=self._border)
+        sbox.pack_start(child=self.search, expand=True, fill=True, padding=0)
+        sbox.pack_start(child=self.flat, expand=False, fill=False, padding=0)
+        lbox.pack_start(child=sbox, expand=False, fill=False, padding=0)
 
         # treeview with filtering
         self.ts_filter = self.tree_store.filter_new()
@@ -80,6 +409,7 @@ class GTKPass(Gtk.Window):
         self.treeview.set_headers_visible(False)
         self.treeview.connect("key-release-event", self.on_treeview_keypress)
         self.treeview.connect('row-activated', self.on_row_activated)
+        self.treeview.connect('test-expand-row', self.on_test_expand_row)
 
         icon_renderer = Gtk.CellRendererPixbuf()
         text_renderer = Gtk.CellRendererText()
@@ -91,12 +421,17 @@ class GTKPass(Gtk.Window):
         column.add_attribute(icon_renderer, "icon_name", 3)
         self.treeview.append_column(column)
         selection = self.treeview.get_selection()
-        selection.connect('changed', self.on_selected)
+        selection.set_mode(Gtk.SelectionMode.MULTIPLE)
+        self._selection_handler = selection.connect('changed',
+                                                    self.on_selected)
 
-        # scrollview to hold treeview
+        # scrollview to hold treeview, flat view is added on first use
         tv_sw = Gtk.ScrolledWindow()
         tv_sw.add(self.treeview)
-        lbox.pack_start(child=tv_sw, expand=True, fill=True, padding=0)
+        self.views = Gtk.Stack()
+        self.views.add_named(tv_sw, 'tree')
+        self.flatview = None
+        lbox.pack_start(child=self.views, expand=True, fill=True, padding=0)
 
         # display things
         rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
@@ -150,7 +485,7 @@ class GTKPass(Gtk.Window):
         self.search.grab_focus()
         self.show_all()
         self._set_visible(self.grid, False)
-        self.refresh()
+        self._set_busy(True, 'Loading...')
 
     def _set_visible(self, obj, set_visible=True):
         for child in obj.get_children():
@@ -176,82 +511,530 @@ class GTKPass(Gtk.Window):
         b_edit.set_icon_name("document-edit-symbolic")
         toolbar.insert(b_edit, 2)
 
-        b_del = Gtk.ToolButton()
-        b_del.set_icon_name("edit-delete-symbolic")
-        b_del.connect("clicked", self.on_delete)
-        toolbar.insert(b_del, 3)
+        self.b_del = Gtk.ToolButton()
+        self.b_del.set_icon_name("edit-delete-symbolic")
+        self.b_del.connect("clicked", self.on_delete)
+        toolbar.insert(self.b_del, 3)
+
+        self.b_move = Gtk.ToolButton()
+        self.b_move.set_icon_name("document-save-as-symbolic")
+        self.b_move.connect("clicked", self.on_move)
+        toolbar.insert(self.b_move, 4)
+
+        self.b_reencrypt = Gtk.ToolButton()
+        self.b_reencrypt.set_icon_name("channel-secure-symbolic")
+        self.b_reencrypt.connect("clicked", self.on_reencrypt)
+        toolbar.insert(self.b_reencrypt, 5)
+
+        self.b_import = Gtk.ToolButton()
+        self.b_import.set_icon_name("document-open-symbolic")
+        self.b_import.connect("clicked", self.on_import)
+        toolbar.insert(self.b_import, 6)
+
+        self.b_gitpush = Gtk.ToolButton()
+        self.b_gitpush.set_icon_name("go-up-symbolic")
+        self.b_gitpush.connect("clicked", self.on_git_sync, GitSync.PUSH)
+        toolbar.insert(self.b_gitpush, 7)
 
-        b_gitpush = Gtk.ToolButton()
-        b_gitpush.set_icon_name("go-up-symbolic")
-        toolbar.insert(b_gitpush, 4)
+        self.b_gitpull = Gtk.ToolButton()
+        self.b_gitpull.set_icon_name("go-down-symbolic")
+        self.b_gitpull.connect("clicked", self.on_git_sync, GitSync.PULL)
+        toolbar.insert(self.b_gitpull, 8)
 
-        b_gitpull = Gtk.ToolButton()
-        b_gitpull.set_icon_name("go-down-symbolic")
-        toolbar.insert(b_gitpull, 5)
+        # git, re-encryption and import progress
+        self.b_gitcancel = Gtk.ToolButton()
+        self.b_gitcancel.set_icon_name("process-stop-symbolic")
+        self.b_gitcancel.connect("clicked", self.on_cancel)
+        self.b_gitcancel.set_sensitive(False)
+        toolbar.insert(self.b_gitcancel, 9)
+
+        progress = Gtk.ToolItem()
+        pbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
+                       spacing=self._border)
+        self.git_spinner = Gtk.Spinner()
+        self.git_status = Gtk.Label()
+        self.git_status.set_ellipsize(Pango.EllipsizeMode.END)
+        pbox.pack_start(child=self.git_spinner, expand=False, fill=False,
+                        padding=0)
+        pbox.pack_start(child=self.git_status, expand=True, fill=True,
+                        padding=0)
+        progress.add(pbox)
+        progress.set_expand(True)
+        toolbar.insert(progress, 10)
 
         return toolbar
 
+    def _set_busy(self, busy, msg=''):
+        "Disable actions changing the store while one of them is running"
+        for widget in (self.b_del, self.b_move, self.b_reencrypt,
+                       self.b_import, self.b_gitpush, self.b_gitpull):
+            widget.set_sensitive(not busy)
+        self.git_spinner.start() if busy else self.git_spinner.stop()
+        self.git_status.set_text(msg)
+
+    def on_cancel(self, button):
+        for git in self.git.values():
+            git.cancel()
+        self.passs.reencryptor.cancel()
+        self.passs.importer.cancel()
+
+    def on_git_sync(self, button, command):
+        if self._git_pending:
+            return
+        gits = self.git
+        if len(gits) > 1:
+            # mounted stores doesn't have to be git repositories
+            gits = {mount: git for mount, git in gits.items()
+                    if os.path.isdir(os.path.join(git.store_path, '.git'))}
+        if not gits:
+            return
+        self._set_busy(True, f'git {command}...')
+        self.b_gitcancel.set_sensitive(True)
+        self._git_pending = set(gits)
+        self._git_errors = []
+        for mount, git in gits.items():
+            prefix = f'{mount}: ' if mount else ''
+            try:
+                git.run(command,
+                        lambda line, p=prefix: self.git_status.set_text(
+                            p + line),
+                        functools.partial(self.on_git_done, mount))
+            except OSError as exc:
+                self.on_git_done(mount, False, str(exc), [])
+
+    def on_git_done(self, mount, success, msg, changed):
+        self._git_pending.discard(mount)
+        if not success:
+            self._git_errors.append(f'{mount}: {msg}' if mount else msg)
+
+        if changed:
+            # reconcile every directory on the way to changed file, so that
+            # new directories are picked up as well
+            dirnames = set()
+            for path in changed:
+                path = os.path.join(mount, path)
+                if path.endswith('.gpg'):
+                    # watcher might be disabled, or might miss it
+                    self.passs.cache.invalidate(path[:-4])
+                while path:
+                    path = os.path.dirname(path)
+                    dirnames.add(path)
+            self.on_store_changed(dirnames)
+
+        if self._git_pending:
+            return
+        self._set_busy(False, '' if self._git_errors else msg)
+        self.b_gitcancel.set_sensitive(False)
+
+        if self._git_errors:
+            dialog = Gtk.MessageDialog(transient_for=self,
+                                       flags=0,
+                                       message_type=Gtk.MessageType.INFO,
+                                       buttons=Gtk.ButtonsType.CLOSE,
+                                       text='There was an error')
+            dialog.format_secondary_text('\n\n'.join(self._git_errors))
+            dialog.run()
+            dialog.destroy()
+
+    @METRICS.timed('add_nodes')
     def add_nodes(self, data, parent):
         "Create the tree nodes from a hierarchical data structure"
+        self._add_nodes(data, parent)
+
+    def _add_nodes(self, data, parent):
         for obj in data.sorted_children:
+            child = self.tree_store.append(parent, self._make_row(obj))
+            self._rows[obj] = child
             if isinstance(obj, Tree):
-                child = self.tree_store.append(parent,
-                                               [True, obj.name,
-                                                Pango.Weight.NORMAL,
-                                                "folder",
-                                                obj.path,
-                                                False])
-                self.add_nodes(obj, child)
-            else:
-                self.tree_store.append(parent, [True, obj.name,
-                                                Pango.Weight.NORMAL,
-                                                "application-x-generic",
-                                                obj.path,
-                                                True])
+                self._add_subtree(obj, child)
+
+    def _add_subtree(self, obj, treeiter):
+        if obj.loaded:
+            self._add_nodes(obj, treeiter)
+        else:
+            # dummy child, so that the row can be expanded
+            self._placeholders[obj] = self.tree_store.append(
+                treeiter, [True, "...", Pango.Weight.NORMAL, None, "", False])
+
+    def _make_row(self, obj):
+        if isinstance(obj, Tree):
+            return [True, obj.name, Pango.Weight.NORMAL, "folder", obj.path,
+                    False]
+        return [True, obj.name, Pango.Weight.NORMAL, "application-x-generic",
+                obj.path, True]
+
+    def insert_node(self, parent, obj):
+        "Insert node into the tree store, keeping the sort order"
+        position = parent.sorted_children.index(obj)
+        child = self.tree_store.insert(self._rows.get(parent), position,
+                                       self._make_row(obj))
+        self._rows[obj] = child
+        if isinstance(obj, Tree):
+            self._add_subtree(obj, child)
+
+    def load_tree(self, tree):
+        "Read lazily loaded directory, and replace its placeholder row"
+        self.passs.load_dir(tree)
+        self._show_loaded(tree)
+
+    def _show_loaded(self, tree):
+        "Replace placeholder row of just loaded directory with its children"
+        placeholder = self._placeholders.pop(tree, None)
+        if placeholder is not None:
+            self.tree_store.remove(placeholder)
+        self.add_nodes(tree, self._rows.get(tree))
+        if hasattr(self, 'watcher'):
+            self.watcher.watch(tree)
+
+    def on_test_expand_row(self, treeview, treeiter, treepath):
+        tree = self.passs.data.find(treeview.get_model()[treeiter][4])
+        if tree is not None and not tree.loaded:
+            self.load_tree(tree)
+        return False
+
+    def _prepare_index(self):
+        "Build fuzzy search tables ahead of the first query"
+        self.passs.index.table
+        return False
+
+    def _prefetch_next(self):
+        """Have pending directories read in the background, as many at the
+        time as there are scan workers. Rows are added from the main loop,
+        one directory at the time, as they are read."""
+        while self._prefetch and self._prefetching < self.passs.scan_workers:
+            tree = self._prefetch.popleft()
+            if tree not in self._rows:
+                # removed in the meantime
+                continue
+            if tree.loaded:
+                # expanded in the meantime
+                self._prefetch.extend(x for x in tree.children
+                                      if isinstance(x, Tree))
+                continue
+            self._prefetching += 1
+            self.passs.load_dir_async(tree, self.on_prefetched)
+        if not (self._prefetch or self._prefetching) and \
+                self.search.get_text():
+            self.refresh()
+
+    def on_prefetched(self, tree, mtime, children):
+        self._prefetching -= 1
+        if not tree.loaded and tree in self._rows:
+            tree.loaded = True
+            self.passs.attach(tree, mtime, children)
+            self._show_loaded(tree)
+        self._prefetch.extend(x for x in tree.children
+                              if isinstance(x, Tree))
+        self._prefetch_next()
+        return False
+
+    def remove_node(self, obj):
+        "Remove node and its subtree from the tree store"
+        treeiter = self._rows.get(obj)
+        if treeiter is None:
+            return
+        self.tree_store.remove(treeiter)
+        self._forget_rows(obj)
+
+    def _forget_rows(self, obj):
+        self._rows.pop(obj, None)
+        self._placeholders.pop(obj, None)
+        self._hidden.discard(obj)
+        self._bold.discard(obj)
+        if isinstance(obj, Tree):
+            for child in obj.children:
+                self._forget_rows(child)
+
+    @METRICS.timed('store_changed')
+    def on_store_changed(self, dirnames, bulk=False):
+        """Apply changes in given store directories to both, the model and
+        the tree store. With bulk, treeview is detached for the time of the
+        update."""
+        if bulk:
+            self.scheduler.cancel()
+            self.detach_view()
+        # parents first, so that removed subtrees are skipped altogether
+        for dirname in sorted(dirnames, key=lambda x: x.count(os.sep)):
+            tree = self.passs.data.find(dirname)
+            if tree is None:
+                continue
+            self.apply_changes(tree, *self.passs.reconcile_dir(tree))
+        if bulk:
+            self.attach_view()
+        if self.passs.metadata and self.passs.metadata.started:
+            self.passs.metadata.start()
+        if self.search.get_text():
+            self.refresh()
+
+    def on_rescanned(self, fresh):
+        for changes in self.passs.merge_tree(self.passs.data, fresh):
+            self.apply_changes(*changes)
+        if self.search.get_text():
+            self.refresh()
+        self.passs.save_snapshot()
+        return False
+
+    def apply_changes(self, parent, added, removed):
+        "Reflect nodes added to or removed from parent in the tree store"
+        for obj in removed:
+            if hasattr(self, 'watcher'):
+                self.watcher.unwatch(obj)
+            self.remove_node(obj)
+            if obj.path == self._selected:
+                self._selected = None
+        for obj in added:
+            self.insert_node(parent, obj)
+            if hasattr(self, 'watcher'):
+                self.watcher.watch(obj)
 
     def refresh(self, _widget=None):
+        self.scheduler.run()
+
+    def search_changes(self):
+        """Generator computing the tree store changes needed to show results
+        of the query in small steps. It yields between them, so that the
+        search scheduler can spread it over idle slices (and drop it on the
+        next keystroke), and returns query and the list of changes.
+
+        Nothing is changed before the last step, so that it can be dropped
+        at any point."""
         query = self.search.get_text().lower()
+        index = self.passs.index
         if query == "":
-            self.tree_store.foreach(self.reset_row, True)
-            if self._expand:
-                self.treeview.expand_all()
-            else:
-                self.treeview.collapse_all()
+            results = []
+            changes = yield from self.visibility_changes(None, set())
+        elif self._fuzzy:
+            results = yield from index.fuzzy_search_steps(query)
+            matches = set(results)
+            extra = (yield from self.metadata_matches(query)) - matches
+            results = results + sorted(extra, key=lambda x: len(x.path))
+            matches |= extra
+            visible = yield from self.matches_closure(matches)
+            changes = yield from self.visibility_changes(visible, matches)
         else:
-            self.tree_store.foreach(self.reset_row, False)
-            self.tree_store.foreach(self.show_matches, query, True)
-            self.treeview.expand_all()
-        self.ts_filter.refilter()
+            matches = yield from index.search_steps(query)
+            matches |= yield from self.metadata_matches(query)
+            visible = yield from self.matches_closure(matches)
+            results = yield from self._by_length(
+                [x for x in visible if isinstance(x, Leaf)])
+            changes = yield from self.visibility_changes(visible, matches)
+        self._results = results
+        return query, changes
+
+    def metadata_matches(self, query):
+        """Generator of the steps returning entries which user, url or notes
+        contain the query"""
+        if not (self.passs.metadata and self.passs.metadata.started):
+            return set()
+        paths = self.passs.metadata.search(query)
+        yield
+        entries = self.passs.index.entries
+        yield
+        found = (entries.get(x) for x in paths)
+        # entries in not yet loaded directories are not in the tree
+        return {x for x in found if x is not None}
+
+    def _by_length(self, nodes):
+        """Generator of the steps returning nodes sorted by length of their
+        paths"""
+        lengths = {}
+        step = SearchIndex.STEP
+        for start in range(0, len(nodes), step):
+            lengths.update((x, len(x.path))
+                           for x in nodes[start:start + step])
+            yield
+        nodes.sort(key=lengths.__getitem__)
+        return nodes
 
-    def reset_row(self, model, path, iter, make_visible):
-        self.tree_store.set_value(iter, 2, Pango.Weight.NORMAL)
-        self.tree_store.set_value(iter, 0, make_visible)
+    def on_metadata_updated(self):
+        if self.search.get_text():
+            self.refresh()
+        return False
 
-    def make_path_visible(self, model, iter):
-        while iter:
-            self.tree_store.set_value(iter, 0, True)
-            iter = model.iter_parent(iter)
+    def apply_change(self, obj, column, value):
+        treeiter = self._rows.get(obj)
+        if treeiter is not None:
+            self.tree_store.set_value(treeiter, column, value)
 
-    def make_subtree_visible(self, model, iter):
-        for i in range(model.iter_n_children(iter)):
-            subtree = model.iter_nth_child(iter, i)
-            if model.get_value(subtree, 0):
+    def revert_changes(self, changes):
+        "Bring back state for changes which were not applied after all"
+        for obj, column, value in changes:
+            if column == 0 and value:
+                self._hidden.add(obj)
+            elif column == 0:
+                self._hidden.discard(obj)
+            elif value == Pango.Weight.BOLD:
+                self._bold.discard(obj)
+            else:
+                self._bold.add(obj)
+
+    def detach_view(self):
+        """Detach treeview from the model, so that bulk updates doesn't emit
+        signals for every row"""
+        selection = self.treeview.get_selection()
+        model, treepaths = selection.get_selected_rows()
+        # rows might be gone once the view is attached again, so only the
+        # store paths are remembered
+        self._detached_selection = [(model[x][4], model[x][5])
+                                    for x in treepaths]
+        selection.handler_block(self._selection_handler)
+        self.treeview.set_model(None)
+
+    def attach_view(self):
+        selection = self.treeview.get_selection()
+        self.treeview.set_model(self.ts_filter)
+        items = self._detached_selection
+        self._detached_selection = []
+        for path, is_leaf in items:
+            treeiter = self._rows.get(self.passs.data.find(path, is_leaf))
+            if treeiter is None or not self.tree_store.get_value(treeiter,
+                                                                 0):
                 continue
-            self.tree_store.set_value(subtree, 0, True)
-            self.make_subtree_visible(model, subtree)
-
-    def show_matches(self, model, path, iter, query,
-                     show_subtrees_of_matches):
-        text = model.get_value(iter, 1).lower()
-        if query in text:
-            # Highlight direct match with bold
-            self.tree_store.set_value(iter, 2, Pango.Weight.BOLD)
+            found, treeiter = self.ts_filter.convert_child_iter_to_iter(
+                treeiter)
+            if found:
+                self.treeview.expand_to_path(
+                    self.ts_filter.get_path(treeiter))
+                selection.select_iter(treeiter)
+        selection.handler_unblock(self._selection_handler)
+        if len(selection.get_selected_rows()[1]) != len(items):
+            self.on_selected(selection)
+
+    def finish_refresh(self, query):
+        flat = self.update_flat_view()
+        if query and self.passs.prefetcher:
+            top = self.passs.index.rank(query, self._results,
+                                        self.conf.get('prefetch_hits', 3))
+            self.passs.prefetcher.prefetch([x.path for x in top])
+        if query == "" and not self._expand:
+            self.treeview.collapse_all()
+        elif not flat:
+            # expanding thousands of rows is what makes big results slow, so
+            # it is skipped while the flat view is shown instead
+            self.treeview.expand_all()
+
+    def on_flat_toggled(self, button):
+        if not self.update_flat_view() and self.search.get_text():
+            self.treeview.expand_all()
+
+    def update_flat_view(self):
+        """Show ranked results in the flat view, if it is enabled (or there
+        are too many of them for the tree) and there is something to search
+        for. Return whether flat view is shown."""
+        query = self.search.get_text().lower()
+        show = bool(query) and (self.flat.get_active() or
+                                len(self._results) >
+                                self.conf.get('flat_threshold', 1000))
+        if not show:
+            self.views.set_visible_child_name('tree')
+            if self.flatview is not None:
+                self.flatview.set_model(FlatResultModel([]))
+            return False
+
+        if self.flatview is None:
+            self._make_flat_view()
+        self.flatview.set_model(FlatResultModel(
+            self.passs.index.rank(query, self._results)))
+        self.views.set_visible_child_name('flat')
+        return True
+
+    def _make_flat_view(self):
+        "Create list for ranked search results"
+        self.flatview = Gtk.TreeView(model=FlatResultModel([]))
+        self.flatview.set_activate_on_single_click(True)
+        self.flatview.set_headers_visible(False)
+        self.flatview.connect('row-activated', self.on_row_activated)
+        icon_renderer = Gtk.CellRendererPixbuf()
+        text_renderer = Gtk.CellRendererText()
+        column = Gtk.TreeViewColumn()
+        # with rows of the same height, only visible rows are ever measured
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.pack_start(icon_renderer, False)
+        column.pack_start(text_renderer, False)
+        column.add_attribute(text_renderer, "text", 1)
+        column.add_attribute(icon_renderer, "icon_name", 3)
+        self.flatview.append_column(column)
+        self.flatview.set_fixed_height_mode(True)
+        self.flatview.get_selection().set_mode(Gtk.SelectionMode.MULTIPLE)
+        self.flatview.get_selection().connect('changed', self.on_selected)
+
+        flat_sw = Gtk.ScrolledWindow()
+        flat_sw.add(self.flatview)
+        flat_sw.show_all()
+        self.views.add_named(flat_sw, 'flat')
+
+    def matches_closure(self, matches):
+        """Generator of the steps returning set of nodes to be shown for given
+        matches - the matches itself, all of their parents and all of their
+        subtrees"""
+        visible = set()
+        expanded = set()
+        step = SearchIndex.STEP
+        for count, obj in enumerate(list(matches), start=1):
+            if count % step == 0:
+                yield
             # Propagate visibility change up
-            self.make_path_visible(model, iter)
-            if show_subtrees_of_matches:
-                # Propagate visibility change down
-                self.make_subtree_visible(model, iter)
-            return
+            parent = obj.parent
+            while parent is not None and parent not in visible:
+                visible.add(parent)
+                parent = parent.parent
+            # Propagate visibility change down
+            stack = [obj]
+            while stack:
+                node = stack.pop()
+                visible.add(node)
+                if isinstance(node, Tree) and node not in expanded:
+                    expanded.add(node)
+                    stack.extend(node.children)
+                    if len(expanded) % step == 0:
+                        yield
+        visible.discard(self.passs.data)
+        return visible
+
+    def visibility_changes(self, visible, bold):
+        """Generator of the steps returning list of (node, column, value)
+        which needs to be set on the tree store to show only visible nodes
+        (or all of them, if visible is None) and highlight bold ones. Hidden
+        and bold rows are updated only after the last step.
+
+        Only rows on the boundary of the visible set are hidden - rows below
+        hidden one are not shown by the filter anyway, and will be fixed up
+        once their parent becomes visible again."""
+        changes = []
+        rows = self._rows
+        bold = set(bold)
+        if visible is None:
+            shown, hidden = set(self._hidden), set()
+        else:
+            shown = self._hidden & visible
+            hidden = self._hidden - shown
+            parents = [self.passs.data]
+            parents.extend(x for x in visible if isinstance(x, Tree))
+            checked = 0
+            for parent in parents:
+                for obj in parent.children:
+                    if (obj not in visible and obj not in hidden and
+                            obj in rows):
+                        hidden.add(obj)
+                        changes.append((obj, 0, False))
+                checked += len(parent.children)
+                if checked >= SearchIndex.STEP:
+                    checked = 0
+                    yield
+
+        for column, value, nodes in (
+                (0, True, shown),
+                (2, Pango.Weight.NORMAL, self._bold - bold),
+                (2, Pango.Weight.BOLD, bold - self._bold)):
+            nodes = list(nodes)
+            for start in range(0, len(nodes), SearchIndex.STEP):
+                changes.extend((x, column, value)
+                               for x in nodes[start:start + SearchIndex.STEP]
+                               if x in rows)
+                yield
+        self._hidden = hidden
+        self._bold = bold
+        return changes
 
     def on_row_activated(self, treeview, treepath, treeview_col):
         selection = treeview.get_selection()
@@ -259,55 +1042,145 @@ class GTKPass(Gtk.Window):
         if not selection:
             return
 
-        model, treeiter = selection.get_selected()
+        path = treeview.get_model()[treepath][4]
 
-        if (self._selected is not None and
-                self._selected == model[treeiter][4]):
+        if self._selected is not None and self._selected == path:
             self._selected = None
             selection.unselect_all()
         else:
-            self._selected = model[treeiter][4]
+            self._selected = path
 
     def on_selected(self, selection):
-        model, treeiter = selection.get_selected()
+        model, treepaths = selection.get_selected_rows()
 
+        if self._entry is not None:
+            self._entry[1].wipe()
+        self._entry = None
+        self._decrypting = None
+        # decryption the copy request waits for is cancelled or superseded
+        # below, unless it's the very same entry
+        request, self._copy_request = self._copy_request, None
         self.label.set_label('')
         self.password.set_text('')
         self.user.set_text('')
         self.url.set_text('')
         self.textview.get_buffer().set_text('')
 
+        if len(treepaths) > 1:
+            self.passs.cancel_get_pass()
+            self._set_visible(self.grid, False)
+            self.label.set_label(f'<span size="x-large">{len(treepaths)} '
+                                 f'items selected</span>')
+            self.label.set_visible(True)
+            return
+
+        treeiter = model.get_iter(treepaths[0]) if treepaths else None
         if not (treeiter and model[treeiter] and model[treeiter][5]):
+            self.passs.cancel_get_pass()
             self._set_visible(self.grid, False)
             return
 
-        success, data = self.passs.get_pass(model[treeiter][4])
+        path = model[treeiter][4]
+        self._neighbours = self._neighbour_entries(model, treeiter)
+        self._set_visible(self.grid, False)
+        self.label.set_label(f'<span size="x-large" foreground="gray">'
+                             f'Decrypting {GLib.markup_escape_text(path)}...'
+                             f'</span>')
+        self.label.set_visible(True)
+        self._decrypting = path
+        if request is not None and request[0] == path:
+            self._copy_request = request
+        self.passs.get_pass_async(path, self.on_decrypted)
+
+    def _neighbour_entries(self, model, treeiter):
+        """Return paths of the entries on the same level, closest to the
+        treeiter first"""
+        count = self.conf.get('prefetch_siblings', 3)
+        before, after = [], []
+        for step, found in ((model.iter_previous, before),
+                            (model.iter_next, after)):
+            sibling = step(treeiter.copy())
+            while sibling is not None and len(found) < count:
+                if model[sibling][5]:
+                    found.append(model[sibling][4])
+                sibling = step(sibling)
+        return [x for pair in itertools.zip_longest(after, before)
+                for x in pair if x]
+
+    def on_decrypted(self, path, success, data):
+        self._decrypting = None
         if not success:
+            self._copy_request = None
             self.label.set_label(f'<span foreground="red" size="x-large">'
                                  f'There is an error:\n{data}</span>')
             self.label.set_visible(True)
             return
 
-        self.label.set_label(f'<span size="x-large">{model[treeiter][4]}'
-                             f'</span>')
-        output = data.split('\n')
+        if self.passs.prefetcher:
+            self.passs.prefetcher.prefetch(self._neighbours)
 
-        for count, line in enumerate(output):
-            if count == 0:
-                self.password.set_text(line.strip())
-                continue
-            if (output[count].lower().startswith('user:') or
-                    output[count].lower().startswith('username:')):
-                self.user.set_text(line.split(':')[1].strip())
-                continue
-            if output[count].lower().startswith('url:'):
-                self.url.set_text(':'.join(line.split(':')[1:]).strip())
-                continue
-            if output[count].lower().startswith('notes:'):
-                self.textview.get_buffer().set_text("\n".join(output[count:])
-                                                    [6:].strip())
-                break
+        self.label.set_label(f'<span size="x-large">{path}</span>')
+        # wiped when the entry gets deselected
+        self._entry = path, data
+        self.password.set_text(data['password'])
+        self.user.set_text(data['user'])
+        self.url.set_text(data['url'])
+        self.textview.get_buffer().set_text(data['notes'])
         self._set_visible(self.grid, True)
+        self.on_copy_decrypted(path, success, data)
+
+    def on_copy_decrypted(self, path, success, data):
+        "Fulfill pending copy request for the path, if there is any"
+        if self._decrypting not in (None, path):
+            # decryption of the shown entry was superseded by this one
+            self.passs.get_pass_async(self._decrypting, self.on_decrypted)
+        request, self._copy_request = self._copy_request, None
+        shown = self._entry is not None and self._entry[1] is data
+        if request is None or request[0] != path:
+            self._copy_request = request
+        elif not success:
+            self.git_status.set_text(f'Cannot decrypt {path}')
+        else:
+            self.copy_to_clipboard(path, request[1], data)
+        if success and not shown:
+            data.wipe()
+
+    def copy_to_clipboard(self, path, field, fields):
+        if not fields[field]:
+            self.git_status.set_text(f'There is no {field} in {path}')
+            return
+        self.clipboard.copy(fields[field])
+        msg = f'Copied {field} of {path}'
+        if self.clipboard.timeout:
+            msg += f', clearing in {self.clipboard.timeout} s'
+        self.git_status.set_text(msg)
+
+    def copy_field(self, field):
+        """Copy field of the entry under the cursor. If it's not decrypted
+        yet, it's copied as soon as it is, without blocking the UI."""
+        path = self._cursor_entry()
+        if path is None:
+            return
+        if (self._entry is not None and self._entry[0] == path and
+                not self._entry[1].wiped):
+            self.copy_to_clipboard(path, field, self._entry[1])
+            return
+        self._copy_request = path, field
+        if self._decrypting != path:
+            # entry is not shown, so just copy it
+            self.passs.get_pass_async(path, self.on_copy_decrypted)
+
+    def _cursor_entry(self):
+        "Return path of the entry under the cursor of the visible view"
+        if self.views.get_visible_child_name() == 'flat':
+            view = self.flatview
+        else:
+            view = self.treeview
+        treepath = view.get_cursor()[0]
+        if treepath is None:
+            return None
+        row = view.get_model()[treepath]
+        return row[4] if row[5] else None
 
     def on_treeview_keypress(self, treeview, event):
         # expand current branch on right cursor key or enter/return
@@ -344,166 +1217,1512 @@ class GTKPass(Gtk.Window):
             dialog.run()
             dialog.destroy()
 
-        selection = self.treeview.get_selection()
-        if not selection:
-            return
-        tree_model_filter, tree_paths = selection.get_selected_rows()
-        tree_store = tree_model_filter.get_model()
-        tree_iter = None
-        if tree_paths:
-            tree_iter = tree_store.get_iter(tree_paths[0])
+        self.on_store_changed({path})
 
-        self.tree_store.append(tree_iter, [True, dirname,
-                                           Pango.Weight.NORMAL, "folder",
-                                           os.path.join(path, dirname), False])
+    def selected_items(self):
+        """Return store paths and leaf flags of the rows selected in the
+        visible view. Items inside of selected directories are skipped, as
+        they go along with the directory anyway."""
+        if self.views.get_visible_child_name() == 'flat':
+            view = self.flatview
+        else:
+            view = self.treeview
+        model, treepaths = view.get_selection().get_selected_rows()
+        items = [(model[x][4], model[x][5]) for x in treepaths]
+        dirs = tuple(path + os.sep for path, is_leaf in items if not is_leaf)
+        # placeholders of lazily loaded directories doesn't have a path
+        return [(path, is_leaf) for path, is_leaf in items
+                if path and not path.startswith(dirs)]
 
     def on_delete(self, button):
-        if not self._selected:
+        items = self.selected_items()
+        if not items:
             return
 
-        no_rec_confirm = self.conf.get('confirm_recursive_delete') is False
-        no_confirm = self.conf.get('confirm_delete') is False
+        non_empty = [path for path, is_leaf in items
+                     if not is_leaf and not self.passs.is_empty(path)]
+        confirm = self.conf.get('confirm_delete') is not False
+        if (non_empty and
+                self.conf.get('confirm_recursive_delete') is not False):
+            confirm = True
 
-        if no_confirm:
-            result, msg = self.passs.delete(self._selected)
-        else:
+        if confirm:
+            if len(items) == 1:
+                msg = f'Are you sure you want to delete {items[0][0]}?'
+            else:
+                msg = f'Are you sure you want to delete {len(items)} items?'
+            if non_empty:
+                msg += (f'\n\nFollowing directories are not empty, and will '
+                        f'be deleted recursively: {", ".join(non_empty)}')
             dialog = Gtk.MessageDialog(transient_for=self,
                                        flags=0,
                                        message_type=Gtk.MessageType.QUESTION,
                                        buttons=Gtk.ButtonsType.OK_CANCEL,
-                                       text='Removing item from passstore')
-            dialog.format_secondary_text(f'Are you sure you want to delete '
-                                         f'{self._selected}?')
+                                       text='Removing items from passstore')
+            dialog.format_secondary_text(msg)
             response = dialog.run()
             dialog.destroy()
 
-            if response == Gtk.ResponseType.OK:
-                result, msg = self.passs.delete(self._selected)
-            else:
+            if response != Gtk.ResponseType.OK:
                 return
 
-        if result == self.passs.NON_EMPTY:
-            if no_rec_confirm:
-                result, msg = self.passs.delete(self._selected, True)
-            else:
-                dialog = Gtk.MessageDialog(transient_for=self,
-                                           flags=0,
-                                           message_type=Gtk.MessageType
-                                           .QUESTION,
-                                           buttons=Gtk.ButtonsType.OK_CANCEL,
-                                           text='Directory not empty')
-                dialog.format_secondary_text(f'Do you want to delete '
-                                             f'{self._selected} recursively?')
-                response = dialog.run()
-                dialog.destroy()
-
-                if response == Gtk.ResponseType.OK:
-                    result, msg = self.passs.delete(self._selected, True)
-
-        if result == self.passs.ERROR:
+        self._set_busy(True, f'Removing {len(items)} item(s)...')
+        if hasattr(self, 'watcher'):
+            # rows are updated all at once at the end
+            self.watcher.hold()
+        self.passs.batch_delete(items, self.on_batch_done)
+
+    def on_move(self, button):
+        items = self.selected_items()
+        if not items:
+            return
+
+        dialog = MoveDialog(self, [path for path, _ in items])
+        response = dialog.run()
+        target = dialog.get_target()
+        dialog.destroy()
+
+        if response != Gtk.ResponseType.OK or target is None:
+            return
+
+        if len(items) == 1:
+            moves = [(items[0][0], items[0][1], target)]
+        else:
+            moves = [(path, is_leaf,
+                      os.path.join(target, os.path.basename(path)))
+                     for path, is_leaf in items]
+        moves = [(src, is_leaf, dst) for src, is_leaf, dst in moves
+                 if src != dst]
+        if not moves:
+            return
+
+        self._set_busy(True, f'Moving {len(moves)} item(s)...')
+        if hasattr(self, 'watcher'):
+            self.watcher.hold()
+        self.passs.batch_move(moves, self.on_batch_done)
+
+    def on_reencrypt(self, button):
+        items = self.selected_items()
+        if len(items) > 1 or items and items[0][1]:
+            return
+        subdir = items[0][0] if items else ''
+
+        dialog = RecipientsDialog(self, subdir,
+                                  self.passs.recipients(subdir))
+        response = dialog.run()
+        recipients = dialog.get_recipients()
+        dialog.destroy()
+
+        if response != Gtk.ResponseType.OK or not recipients:
+            return
+
+        self._set_busy(True, 'Re-encrypting...')
+        self.b_gitcancel.set_sensitive(True)
+        self.passs.reencryptor.run(subdir, recipients,
+                                   self.on_reencrypt_progress,
+                                   self.on_reencrypt_done)
+
+    def on_reencrypt_progress(self, count, total):
+        self.git_status.set_text(f'Re-encrypting {count}/{total}')
+        return False
+
+    def on_reencrypt_done(self, success, msg):
+        self._set_busy(False, msg if success else '')
+        self.b_gitcancel.set_sensitive(False)
+
+        if not success:
             dialog = Gtk.MessageDialog(transient_for=self,
                                        flags=0,
                                        message_type=Gtk.MessageType.INFO,
                                        buttons=Gtk.ButtonsType.CLOSE,
-                                       text='There was an error')
+                                       text='Re-encryption failed')
             dialog.format_secondary_text(msg)
             dialog.run()
             dialog.destroy()
-        self._selected = None
 
-        # remove selected branch/leaf from store
-        selection = self.treeview.get_selection()
-        tree_model_filter, tree_paths = selection.get_selected_rows()
-        tree_store = tree_model_filter.get_model()
+    def on_import(self, button):
+        items = self.selected_items()
+        if len(items) > 1 or items and items[0][1]:
+            return
+        target = items[0][0] if items else ''
+
+        dialog = Gtk.FileChooserDialog(title=f"Import entries into "
+                                       f"{'/' if not target else target}",
+                                       transient_for=self,
+                                       action=Gtk.FileChooserAction.OPEN)
+        dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                           Gtk.STOCK_OPEN, Gtk.ResponseType.OK)
+        exports = Gtk.FileFilter()
+        exports.set_name('CSV or KeePass XML')
+        exports.add_pattern('*.csv')
+        exports.add_pattern('*.xml')
+        dialog.add_filter(exports)
+        response = dialog.run()
+        fname = dialog.get_filename()
+        dialog.destroy()
+
+        if response != Gtk.ResponseType.OK or not fname:
+            return
+
+        self._set_busy(True, 'Importing...')
+        self.b_gitcancel.set_sensitive(True)
+        if hasattr(self, 'watcher'):
+            # new rows are added all at once at the end
+            self.watcher.hold()
+        self.passs.importer.run(fname, target, self.on_import_progress,
+                                self.on_import_done)
+
+    def on_import_progress(self, count):
+        self.git_status.set_text(f'Imported {count} entries')
+        return False
+
+    def on_import_done(self, success, msg, dirnames):
+        self._set_busy(False, msg if success else '')
+        self.b_gitcancel.set_sensitive(False)
+        if hasattr(self, 'watcher'):
+            dirnames |= self.watcher.release()
+        self.on_store_changed(dirnames, bulk=True)
+
+        if not success:
+            dialog = Gtk.MessageDialog(transient_for=self,
+                                       flags=0,
+                                       message_type=Gtk.MessageType.INFO,
+                                       buttons=Gtk.ButtonsType.CLOSE,
+                                       text='Import failed')
+            dialog.format_secondary_text(msg)
+            dialog.run()
+            dialog.destroy()
 
-        for path in tree_paths:
-            tree_iter = tree_store.get_iter(path)
-            tree_store.remove(tree_iter)
+    def on_batch_done(self, errors, dirnames):
+        self._set_busy(False)
+        if hasattr(self, 'watcher'):
+            dirnames |= self.watcher.release()
+        self.on_store_changed(dirnames, bulk=True)
+
+        if errors:
+            dialog = Gtk.MessageDialog(transient_for=self,
+                                       flags=0,
+                                       message_type=Gtk.MessageType.INFO,
+                                       buttons=Gtk.ButtonsType.CLOSE,
+                                       text='There was an error')
+            dialog.format_secondary_text('\n'.join(errors))
+            dialog.run()
+            dialog.destroy()
+        return False
 
     def on_key_press_event(self, widget, event):
         ctrl = (event.state & Gdk.ModifierType.CONTROL_MASK)
-        if ctrl and event.keyval == Gdk.KEY_b:
-            if self.user.get_text != '':
-                self.clipboard.set_text(self.user.get_text(), -1)
-        elif ctrl and event.keyval == Gdk.KEY_c:
-            if self.password.get_text != '':
-                self.clipboard.set_text(self.password.get_text(), -1)
-        # TODO: clear clipboard after a minute or so.
+        if event.keyval == Gdk.KEY_F12 and METRICS.enabled:
+            MetricsDialog(self).show()
+            return True
+        # anywhere else the shortcuts belong to the focused widget, which
+        # might have some text selected
+        views = self.treeview.has_focus() or (self.flatview is not None and
+                                              self.flatview.has_focus())
+        if views and ctrl and event.keyval == Gdk.KEY_b:
+            self.copy_field('user')
+            return True
+        elif views and ctrl and event.keyval == Gdk.KEY_c:
+            self.copy_field('password')
+            return True
+        return False
 
 
-class NewDirDialog(Gtk.Dialog):
-    def __init__(self, parent, path):
-        super().__init__(title="Enter new directory", transient_for=parent,
-                         flags=0)
-        self.set_modal(True)
-        self.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
-                         Gtk.STOCK_OK, Gtk.ResponseType.OK)
+class ClipboardManager:
+    """Copy secrets to the clipboard, and clear it after the timeout, but
+    only if it still holds the copied value - anything copied in the
+    meantime is left alone"""
 
-        label = Gtk.Label(label=f"Create new directory under "
-                          f"{'/' if not path else path} path")
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        # only the digest of the copied value is kept around
+        self._digest = None
+        self._timer = None
 
-        box = self.get_content_area()
-        box.add(label)
-        self.entry = Gtk.Entry()
-        self.entry.connect("key-release-event", self.on_release_key)
-        box.add(self.entry)
-        self.show_all()
+    def set_text(self, text):
+        self.clipboard.set_text(text, -1)
 
-    def on_release_key(self, entry, event):
-        if event.keyval == Gdk.KEY_Return:
-            self.response(Gtk.ResponseType.OK)
+    def request_text(self, callback, data):
+        self.clipboard.request_text(callback, data)
 
-    def get_dirname(self):
-        return self.entry.get_text()
+    def wait_for_text(self):
+        return self.clipboard.wait_for_text()
 
+    def copy(self, text):
+        self._cancel_timer()
+        self.set_text(text)
+        if self.timeout:
+            self._digest = hashlib.sha256(text.encode()).digest()
+            self._timer = GLib.timeout_add_seconds(self.timeout,
+                                                   self._on_timeout)
 
-class Leaf:
-    """A simple class to hold Leaf data"""
-    def __init__(self, name, path):
-        self.name = name
-        self.path = path
+    def clear(self, wait=False):
+        """Clear the clipboard, if it still holds the copied value. With
+        wait, clipboard is checked right away, i.e. before exiting."""
+        self._cancel_timer()
+        digest, self._digest = self._digest, None
+        if digest is None:
+            return
+        if wait:
+            self._on_text(self, self.wait_for_text(), digest)
+        else:
+            self.request_text(self._on_text, digest)
 
-    def __repr__(self):
-        return f"Leaf: {self.name}"
+    def _cancel_timer(self):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
 
+    def _on_timeout(self):
+        self._timer = None
+        self.clear()
+        return False
 
-class Tree:
-    """A class to hold and manipulate leafs/other branches"""
-    def __init__(self, name=None, path=None):
-        self.name = name
-        self.children = []
-        self.path = path
+    def _on_text(self, clipboard, text, digest):
+        if (text is not None and
+                hashlib.sha256(text.encode()).digest() == digest):
+            self.set_text('')
 
-    def __repr__(self):
-        return f"Tree: {self.name}"
 
-    @property
-    def sorted_children(self):
-        files = {}
-        dirs = {}
-        for i in self.children:
-            if isinstance(i, Leaf):
-                files[i.name] = i
-            else:
-                dirs[i.name] = i
-        return ([dirs[x] for x in sorted(dirs)] +
-                [files[x] for x in sorted(files)])
+class CommandClipboard(ClipboardManager):
+    """Clipboard for the daemon, which doesn't connect to the display itself,
+    using wl-clipboard on Wayland and xclip on X11"""
+    COMMANDS = {'wayland': (['wl-copy'], ['wl-paste', '-n']),
+                'x11': (['xclip', '-selection', 'clipboard'],
+                        ['xclip', '-o', '-selection', 'clipboard'])}
 
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._digest = None
+        self._timer = None
+        kind = 'wayland' if os.environ.get('WAYLAND_DISPLAY') else 'x11'
+        self._copy, self._paste = self.COMMANDS[kind]
+        if not shutil.which(self._copy[0]):
+            raise OSError(f'{self._copy[0]} executable not found')
 
-class PassStore:
+    def set_text(self, text):
+        # both of them stay in the background serving the selection, so
+        # their output must not be captured
+        subprocess.run(self._copy, input=text.encode(),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+
+    def request_text(self, callback, data):
+        callback(self, self.wait_for_text(), data)
+
+    def wait_for_text(self):
+        proc = subprocess.run(self._paste, capture_output=True)
+        if proc.returncode != 0:
+            return None
+        return proc.stdout.decode('utf-8', 'replace')
+
+
+class FlatResultModel(GObject.Object, Gtk.TreeModel):
+    """List model over the ranked search results. Rows are computed only when
+    view asks for them, so together with fixed height mode the cost of
+    showing results doesn't depend on their number.
+
+    It has the same columns as the tree store. Iterators hold index of the
+    row plus one, as zero would be lost as NULL pointer."""
+    COLUMNS = (GObject.TYPE_BOOLEAN, GObject.TYPE_STRING, Pango.Weight,
+               GObject.TYPE_STRING, GObject.TYPE_STRING,
+               GObject.TYPE_BOOLEAN)
+
+    def __init__(self, nodes):
+        super().__init__()
+        self.nodes = nodes
+        self._stamp = id(self) & 0x7fffffff
+
+    def _iter(self, index):
+        if not 0 <= index < len(self.nodes):
+            return False, None
+        treeiter = Gtk.TreeIter()
+        treeiter.stamp = self._stamp
+        treeiter.user_data = index + 1
+        return True, treeiter
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.COLUMNS)
+
+    def do_get_column_type(self, column):
+        return self.COLUMNS[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) != 1:
+            return False, None
+        return self._iter(indices[0])
+
+    def do_get_path(self, treeiter):
+        return Gtk.TreePath.new_from_indices([treeiter.user_data - 1])
+
+    def do_get_value(self, treeiter, column):
+        obj = self.nodes[treeiter.user_data - 1]
+        return (True, obj.path, Pango.Weight.NORMAL, "application-x-generic",
+                obj.path, True)[column]
+
+    def do_iter_next(self, treeiter):
+        found, following = self._iter(treeiter.user_data)
+        if found:
+            treeiter.user_data = following.user_data
+            return True, treeiter
+        return False, None
+
+    def do_iter_previous(self, treeiter):
+        found, previous = self._iter(treeiter.user_data - 2)
+        if found:
+            treeiter.user_data = previous.user_data
+            return True, treeiter
+        return False, None
+
+    def do_iter_children(self, parent):
+        if parent is not None:
+            return False, None
+        return self._iter(0)
+
+    def do_iter_has_child(self, treeiter):
+        return False
+
+    def do_iter_n_children(self, treeiter):
+        return len(self.nodes) if treeiter is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is not None:
+            return False, None
+        return self._iter(n)
+
+    def do_iter_parent(self, child):
+        return False, None
+
+
+class SearchScheduler:
+    """Debounce search queries, and both compute and apply the tree store
+    changes in small time slices from the idle loop, so that typing is never
+    blocked. Next keystroke drops whatever is left of the previous search."""
+    SLICE = 0.008  # s
+    BULK = 1000  # number of changes for detaching the treeview
+
+    def __init__(self, app, delay):
+        self.app = app
+        self.delay = delay
+        self._timeout = None
+        self._idle = None
+        self._search = None
+        self._spent = 0
+        self._changes = []
+        self._query = None
+        self._detached = False
+        self._started = None
+
+    @property
+    def pending(self):
+        "Whether there is a search waiting or being applied"
+        return self._timeout is not None or self._idle is not None
+
+    def schedule(self):
+        "Run the search after the delay, unless there is another keystroke"
+        self.cancel()
+        self._timeout = GLib.timeout_add(self.delay, self._on_timeout)
+
+    def run(self):
+        self.cancel()
+        self._started = time.perf_counter()
+        self._spent = 0
+        self._search = self.app.search_changes()
+        self._idle = GLib.idle_add(self._step,
+                                   priority=GLib.PRIORITY_DEFAULT_IDLE)
+
+    def cancel(self):
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+        if self._idle is not None:
+            GLib.source_remove(self._idle)
+            self._idle = None
+        if self._search is not None:
+            self._search.close()
+            self._search = None
+        if self._changes:
+            self.app.revert_changes(self._changes)
+            self._changes = []
+        if self._detached:
+            self._detached = False
+            self.app.attach_view()
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.run()
+        return False
+
+    def _step(self):
+        deadline = time.monotonic() + self.SLICE
+        if self._search is not None and not self._compute(deadline):
+            return True
+        changes = self._changes
+        while changes:
+            self.app.apply_change(*changes.pop())
+            if time.monotonic() > deadline:
+                return True
+
+        self._idle = None
+        if self._detached:
+            self._detached = False
+            self.app.attach_view()
+        self.app.finish_refresh(self._query)
+        if METRICS.enabled:
+            # from the search to the last row updated
+            METRICS.record('refresh', time.perf_counter() - self._started)
+        return False
+
+    def _compute(self, deadline):
+        """Run steps of the search until the deadline. Return whether the
+        changes are ready."""
+        start = time.perf_counter()
+        try:
+            while time.monotonic() < deadline:
+                next(self._search)
+            return False
+        except StopIteration as stop:
+            self._search = None
+            self._query, changes = stop.value
+        finally:
+            self._spent += time.perf_counter() - start
+        if METRICS.enabled:
+            # time of the search itself, without waiting for the slices
+            METRICS.record('search', self._spent)
+        # reversed, so that changes can be popped from the end
+        self._changes = changes[::-1]
+        if len(changes) > self.BULK:
+            self._detached = True
+            self.app.detach_view()
+        return True
+
+
+class NewDirDialog(Gtk.Dialog):
+    def __init__(self, parent, path):
+        super().__init__(title="Enter new directory", transient_for=parent,
+                         flags=0)
+        self.set_modal(True)
+        self.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                         Gtk.STOCK_OK, Gtk.ResponseType.OK)
+
+        label = Gtk.Label(label=f"Create new directory under "
+                          f"{'/' if not path else path} path")
+
+        box = self.get_content_area()
+        box.add(label)
+        self.entry = Gtk.Entry()
+        self.entry.connect("key-release-event", self.on_release_key)
+        box.add(self.entry)
+        self.show_all()
+
+    def on_release_key(self, entry, event):
+        if event.keyval == Gdk.KEY_Return:
+            self.response(Gtk.ResponseType.OK)
+
+    def get_dirname(self):
+        return self.entry.get_text()
+
+
+class MoveDialog(Gtk.Dialog):
+    def __init__(self, parent, items):
+        super().__init__(title="Move items", transient_for=parent, flags=0)
+        self.set_modal(True)
+        self.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                         Gtk.STOCK_OK, Gtk.ResponseType.OK)
+
+        self.entry = Gtk.Entry()
+        if len(items) == 1:
+            label = Gtk.Label(label=f"Enter new path for {items[0]}")
+            self.entry.set_text(items[0])
+        else:
+            label = Gtk.Label(label=f"Enter directory to move {len(items)} "
+                              f"items into")
+            self.entry.set_text(os.path.commonpath(items))
+
+        box = self.get_content_area()
+        box.add(label)
+        self.entry.connect("key-release-event", self.on_release_key)
+        box.add(self.entry)
+        self.show_all()
+
+    def on_release_key(self, entry, event):
+        if event.keyval == Gdk.KEY_Return:
+            self.response(Gtk.ResponseType.OK)
+
+    def get_target(self):
+        "Return store path entered, '' for the store root or None"
+        text = self.entry.get_text().strip()
+        if not text:
+            return None
+        path = os.path.normpath(text).strip(os.sep)
+        return '' if path == '.' else path
+
+
+class RecipientsDialog(Gtk.Dialog):
+    def __init__(self, parent, path, recipients):
+        super().__init__(title="Re-encrypt entries", transient_for=parent,
+                         flags=0)
+        self.set_modal(True)
+        self.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                         Gtk.STOCK_OK, Gtk.ResponseType.OK)
+
+        label = Gtk.Label(label=f"Enter GPG ids to re-encrypt "
+                          f"{'/' if not path else path} for")
+
+        box = self.get_content_area()
+        box.add(label)
+        self.entry = Gtk.Entry()
+        self.entry.set_text(' '.join(recipients))
+        self.entry.connect("key-release-event", self.on_release_key)
+        box.add(self.entry)
+        self.show_all()
+
+    def on_release_key(self, entry, event):
+        if event.keyval == Gdk.KEY_Return:
+            self.response(Gtk.ResponseType.OK)
+
+    def get_recipients(self):
+        return self.entry.get_text().split()
+
+
+class MetricsDialog(Gtk.Dialog):
+    """Debug panel with the counters and latency percentiles, updated every
+    second while it's open"""
+    COLUMNS = ('operation', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')
+
+    def __init__(self, parent):
+        super().__init__(title="Metrics", transient_for=parent, flags=0)
+        self.add_buttons(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
+        self.connect('response', lambda *_: self.destroy())
+        self.set_default_size(480, 360)
+
+        self.store = Gtk.ListStore(*[str] * len(self.COLUMNS))
+        view = Gtk.TreeView(model=self.store)
+        for index, title in enumerate(self.COLUMNS):
+            renderer = Gtk.CellRendererText()
+            if index:
+                renderer.set_property('xalign', 1.0)
+            view.append_column(Gtk.TreeViewColumn(title, renderer,
+                                                  text=index))
+        scroll = Gtk.ScrolledWindow()
+        scroll.add(view)
+        self.get_content_area().pack_start(scroll, True, True, 0)
+
+        self.update()
+        self._timeout = GLib.timeout_add_seconds(1, self.update)
+        self.connect('destroy', lambda _: GLib.source_remove(self._timeout))
+        self.show_all()
+
+    def update(self):
+        report = METRICS.report()
+        self.store.clear()
+        for name, stats in report['latency'].items():
+            self.store.append([name, str(report['counters'].get(name, 0))] +
+                              [f'{stats[x]:.1f}' for x in ('p50', 'p95', 'p99',
+                                                           'max')])
+        for name, value in sorted(report['counters'].items()):
+            if name not in report['latency']:
+                self.store.append([name, str(value), '', '', '', ''])
+        return True
+
+
+class Node:
+    """Base for the tree nodes. Only the name is stored, path in the store
+    is computed out of the parents."""
+    __slots__ = ('name', 'parent')
+
+    def __init__(self, name):
+        self.name = sys.intern(name) if name else name
+        self.parent = None
+
+    @property
+    def path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/'.join(reversed(names))
+
+
+class Leaf(Node):
+    """A simple class to hold Leaf data"""
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"Leaf: {self.name}"
+
+
+class Tree(Node):
+    """A class to hold and manipulate leafs/other branches"""
+    __slots__ = ('children', 'loaded', 'mtime', '_sorted')
+
+    def __init__(self, name=None, loaded=True):
+        super().__init__(name)
+        self.children = []
+        self.loaded = loaded
+        self.mtime = None
+        self._sorted = None
+
+    def __repr__(self):
+        return f"Tree: {self.name}"
+
+    def add_child(self, node):
+        self.children.append(node)
+        node.parent = self
+        self._sorted = None
+
+    def remove_child(self, node):
+        # parent is kept, so that path of removed node can be still figured
+        # out
+        self.children.remove(node)
+        self._sorted = None
+
+    def find(self, path, is_leaf=False):
+        """Return subtree (or entry, with is_leaf) for given store path, or
+        None if there is no such node"""
+        node = self
+        names = path.split(os.sep) if path else []
+        for count, name in enumerate(names, start=1):
+            kind = Leaf if is_leaf and count == len(names) else Tree
+            for child in node.children:
+                if isinstance(child, kind) and child.name == name:
+                    node = child
+                    break
+            else:
+                return None
+        return node
+
+    @property
+    def sorted_children(self):
+        """Directories first, then entries, both sorted by name"""
+        if self._sorted is None:
+            self._sorted = sorted(self.children, key=_node_key)
+        return self._sorted
+
+
+class SearchIndex:
+    """Trigram index of node names, and a table of lowercase entry paths for
+    fuzzy matching. Searching for a query which extends the previous one will
+    only narrow down the previous result."""
+    SCORE_LIMIT = 2000
+    STEP = 2000  # nodes checked between the yields of the search steps
+    SCAN_STEP = 50000  # characters of the path table scanned between them
+
+    def __init__(self):
+        self._version = 0
+        self._names = {}
+        self._grams = collections.defaultdict(set)
+        self._last = None, set()
+        self._last_fuzzy = None, set()
+        self._paths = None
+        self._entries = None
+        self._table = None
+        self._chars = None
+
+    def add(self, node):
+        "Add node and its subtree to the index"
+        name = node.name.lower()
+        self._names[node] = name
+        for gram in _trigrams(name):
+            self._grams[gram].add(node)
+        self._invalidate()
+        if isinstance(node, Tree):
+            for child in node.children:
+                self.add(child)
+
+    def remove(self, node):
+        "Remove node and its subtree from the index"
+        name = self._names.pop(node, None)
+        if name is not None:
+            for gram in _trigrams(name):
+                self._grams[gram].discard(node)
+                if not self._grams[gram]:
+                    del self._grams[gram]
+        self._invalidate()
+        if isinstance(node, Tree):
+            for child in node.children:
+                self.remove(child)
+
+    def search(self, query):
+        """Return set of nodes which name contains query"""
+        return _run_steps(self.search_steps(query))
+
+    def search_steps(self, query):
+        """Generator doing the search in small steps, yielding between them,
+        so that it can be spread over idle slices. Returns what search
+        does."""
+        version = self._version
+        last_query, last = self._last
+        if last_query is not None and last_query in query:
+            candidates = last
+        elif len(query) < 3:
+            candidates = self._names
+        else:
+            sets = sorted((self._grams.get(x, ()) for x in _trigrams(query)),
+                          key=len)
+            candidates = set(sets[0]).intersection(*sets[1:])
+
+        names = self._names
+        candidates = list(candidates)
+        matches = set()
+        for start in range(0, len(candidates), self.STEP):
+            # nodes might be removed while waiting for the next step
+            matches.update(x for x in candidates[start:start + self.STEP]
+                           if query in names.get(x, ''))
+            yield
+        if version == self._version:
+            self._last = query, matches
+        return matches
+
+    def fuzzy_search(self, query):
+        """Return list of entries which path contains all the query characters
+        in the same order, shortest paths first"""
+        return _run_steps(self.fuzzy_search_steps(query))
+
+    def fuzzy_search_steps(self, query):
+        """Generator doing the fuzzy search in small steps, like
+        search_steps"""
+        version = self._version
+        last_query, last = self._last_fuzzy
+        # tables are built in steps as well, first search after any change
+        # of the index would take long otherwise
+        paths, table, chars = yield from self._table_steps()
+        if len(query) == 1:
+            # a copy, as the caller might extend it
+            matches = list(chars.get(query, ()))
+        else:
+            # only entries containing the rarest of the query characters (or
+            # the previous result) are scanned, unless it is most of them
+            candidates = min((chars.get(x, ()) for x in set(query)), key=len)
+            if (last_query is not None and query.startswith(last_query) and
+                    len(last) < len(candidates)):
+                candidates = last
+            if len(candidates) < len(paths) // 2:
+                text, offsets = yield from self._join_steps(candidates, paths)
+            else:
+                text, offsets = table
+            pattern = _fuzzy_pattern(query, True)
+            matches = []
+            pos = 0
+            while pos < len(text):
+                # whole lines only, so that each match starts the line
+                end = text.find('\n', pos + self.SCAN_STEP)
+                if end < 0:
+                    end = len(text)
+                matches.extend(offsets[m.start()]
+                               for m in pattern.finditer(text, pos, end))
+                pos = end + 1
+                yield
+        if version == self._version:
+            self._last_fuzzy = query, matches
+        return matches
+
+    def rank(self, query, nodes, limit=None):
+        """Return entries sorted by the fuzzy match score of their paths,
+        best first.
+
+        To keep it fast enough for interactive use, only the first
+        SCORE_LIMIT nodes are scored, the rest is appended in the given
+        order."""
+        pattern = _fuzzy_pattern(query)
+        paths = self.paths
+        nodes = [x for x in nodes if x in paths]
+        rest = nodes[self.SCORE_LIMIT:]
+        scored = []
+        for count, node in enumerate(nodes[:self.SCORE_LIMIT]):
+            path = paths[node]
+            score = 0
+            basename = path.rfind('/') + 1
+            match = pattern.match(path)
+            if match:
+                score = _fuzzy_score(path, match.regs, basename)
+                if match.start(1) < basename:
+                    # try also to match just the entry name, which usually
+                    # gives better alignment
+                    match = pattern.match(path, basename)
+                    if match:
+                        score = max(score, _fuzzy_score(path, match.regs,
+                                                        basename))
+            # count keeps nodes of the same lowercase path out of comparison
+            scored.append((-score, len(path), path, count, node))
+        if limit is None:
+            scored.sort()
+        else:
+            scored = heapq.nsmallest(limit, scored)
+            rest = rest[:limit - len(scored)]
+        return [x[4] for x in scored] + rest
+
+    @property
+    def paths(self):
+        """Lowercase paths of all the entries"""
+        if self._paths is None:
+            self._paths = _run_steps(self._paths_steps())
+        return self._paths
+
+    @property
+    def entries(self):
+        """Mapping of paths of all the entries to their nodes"""
+        if self._entries is None:
+            self._entries = {x.path: x for x in self.paths}
+        return self._entries
+
+    @property
+    def table(self):
+        """All the entry paths joined by newlines, and mapping of offsets of
+        each line to its node"""
+        if self._table is None:
+            _run_steps(self._table_steps())
+        return self._table
+
+    @property
+    def chars(self):
+        """Lists of entries containing given character, shortest paths
+        first"""
+        self.table
+        return self._chars
+
+    def _paths_steps(self):
+        leaves = [x for x in self._names if isinstance(x, Leaf)]
+        paths = {}
+        for start in range(0, len(leaves), self.STEP):
+            paths.update((x, x.path.lower())
+                         for x in leaves[start:start + self.STEP])
+            yield
+        return paths
+
+    def _table_steps(self):
+        """Generator building paths, table and chars in steps, unless they
+        are built already. Returns all three of them."""
+        if self._table is not None:
+            return self._paths, self._table, self._chars
+        version = self._version
+        paths = self._paths
+        if paths is None:
+            paths = yield from self._paths_steps()
+        nodes = sorted(paths, key=lambda x: len(paths[x]))
+        yield
+        table = yield from self._join_steps(nodes, paths)
+        chars = collections.defaultdict(list)
+        for count, node in enumerate(nodes, start=1):
+            for char in set(paths[node]):
+                chars[char].append(node)
+            if count % self.STEP == 0:
+                yield
+        # nodes might have been added or removed in the meantime
+        if version == self._version:
+            self._paths, self._table, self._chars = paths, table, chars
+        return paths, table, chars
+
+    def _join_steps(self, nodes, paths):
+        offsets = {}
+        lines = []
+        pos = 0
+        for count, node in enumerate(nodes, start=1):
+            path = paths[node]
+            offsets[pos] = node
+            lines.append(path)
+            pos += len(path) + 1
+            if count % self.STEP == 0:
+                yield
+        return '\n'.join(lines), offsets
+
+    def _invalidate(self):
+        self._version += 1
+        self._last = None, set()
+        self._last_fuzzy = None, set()
+        self._paths = None
+        self._entries = None
+        self._table = None
+        self._chars = None
+
+
+class SecretEntry:
+    """Decrypted entry kept in a single mutable buffer, so that the plaintext
+    can be wiped once it's not needed. Fields are located only once, as
+    offsets into the buffer, and turned into text only when asked for."""
+    __slots__ = ('_buf', '_view', '_fields')
+    FIELDS = ('password', 'user', 'url', 'notes')
+    _KEY = re.compile(rb'(?:(user|username)|(url)|(notes)):', re.I)
+    _SPACE = b' \t\r\n\x0b\x0c'
+
+    def __init__(self, data=b''):
+        # bytearray is taken over, anything else is copied
+        self._buf = data if isinstance(data, bytearray) else bytearray(data)
+        self._view = None
+        self._fields = None
+
+    def __getitem__(self, name):
+        "Return text of the field"
+        start, end = self.offsets[name]
+        if self._view is None:
+            self._view = memoryview(self._buf)
+        # decoded straight from the buffer, without copying the bytes
+        return str(self._view[start:end], 'utf-8', 'replace')
+
+    @property
+    def offsets(self):
+        "Dict of field names and their (start, end) offsets in the buffer"
+        if self._fields is None:
+            self._fields = self._parse()
+        return self._fields
+
+    @property
+    def wiped(self):
+        return not self._buf
+
+    def copy(self):
+        entry = SecretEntry(bytearray(self._buf))
+        entry._fields = self._fields
+        return entry
+
+    def wipe(self):
+        "Overwrite the plaintext with zeros"
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        self._buf[:] = bytes(len(self._buf))
+        self._buf.clear()
+        self._fields = None
+
+    def _parse(self):
+        """Find the fields the same way pass clients do: password is the
+        first line, user, url and notes follow their prefixes, and notes go
+        until the end"""
+        buf = self._buf
+        fields = dict.fromkeys(self.FIELDS, (0, 0))
+        end = buf.find(b'\n')
+        end = len(buf) if end < 0 else end
+        fields['password'] = self._strip(0, end)
+        while end < len(buf):
+            pos = end + 1
+            end = buf.find(b'\n', pos)
+            end = len(buf) if end < 0 else end
+            match = self._KEY.match(buf, pos, end)
+            if match is None:
+                continue
+            if match.lastindex == 1:
+                # value ends with the next colon, if any
+                colon = buf.find(b':', match.end(), end)
+                fields['user'] = self._strip(match.end(),
+                                             end if colon < 0 else colon)
+            elif match.lastindex == 2:
+                fields['url'] = self._strip(match.end(), end)
+            else:
+                fields['notes'] = self._strip(match.end(), len(buf))
+                break
+        return fields
+
+    def _strip(self, start, end):
+        buf = self._buf
+        while start < end and buf[start] in self._SPACE:
+            start += 1
+        while end > start and buf[end - 1] in self._SPACE:
+            end -= 1
+        return start, end
+
+
+class SecretCache:
+    """LRU cache of decrypted entries, which expires after ttl seconds.
+    Zero size disables it. Cache owns the entries put in it, and wipes them
+    once they're dropped, so that copies are handed out."""
+    def __init__(self, size=0, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def get(self, path):
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._data.get(path)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[path]
+                item[1].wipe()
+                return None
+            self._data.move_to_end(path)
+            return item[1].copy()
+
+    def __contains__(self, path):
+        with self._lock:
+            item = self._data.get(path)
+            return item is not None and item[0] >= time.monotonic()
+
+    def put(self, path, entry, ttl=None):
+        if not self.enabled:
+            entry.wipe()
+            return
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            old = self._data.pop(path, None)
+            if old is not None:
+                old[1].wipe()
+            self._data[path] = (time.monotonic() + ttl, entry)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)[1][1].wipe()
+
+    def invalidate(self, path):
+        with self._lock:
+            item = self._data.pop(path, None)
+            if item is not None:
+                item[1].wipe()
+
+    def purge(self):
+        now = time.monotonic()
+        with self._lock:
+            for path in [p for p, (exp, _) in self._data.items()
+                         if exp < now]:
+                self._data.pop(path)[1].wipe()
+
+    def clear(self):
+        with self._lock:
+            for _, entry in self._data.values():
+                entry.wipe()
+            self._data.clear()
+
+
+class PassBackend:
+    """Decrypt entries using pass command"""
+    name = 'pass'
+    can_prefetch = False
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+
+    def decrypt(self, path, interactive=True):
+        """Return tuple of success flag and decrypted SecretEntry or error
+        message. Non interactive decryption must never ask for the
+        passphrase."""
+        if not interactive:
+            return False, 'pass cannot decrypt without pinentry'
+        return _decrypt_command(['pass', path],
+                                dict(os.environ,
+                                     PASSWORD_STORE_DIR=self.store_path))
+
+
+class GpgBackend(PassBackend):
+    """Run gpg directly with the very same options pass does, which saves
+    spawning pass shell script and all of its helpers for every entry"""
+    name = 'gpg'
+    can_prefetch = True
+
+    def __init__(self, store_path):
+        super().__init__(store_path)
+        self.gpg, self.options = _gpg_command()
+        # start the agent upfront, so that first decryption doesn't pay for
+        # it, and without holding up the startup
+        threading.Thread(target=subprocess.run,
+                         args=(['gpgconf', '--launch', 'gpg-agent'],),
+                         kwargs={'capture_output': True}, daemon=True).start()
+
+    def decrypt(self, path, interactive=True):
+        fname = _entry_file(self.store_path, path)
+        if fname is None:
+            return False, f'Invalid entry path {path}'
+        options = self.options
+        if not interactive:
+            options = options + ['--batch', '--pinentry-mode', 'error']
+        return _decrypt_command([self.gpg, '-d'] + options + [fname])
+
+
+class GpgmeBackend(PassBackend):
+    """Decrypt using GPGME bindings, which keep connection to the gpg-agent
+    open instead of spawning gpg for every entry"""
+    name = 'gpgme'
+    can_prefetch = True
+
+    def __init__(self, store_path):
+        global gpgme
+        super().__init__(store_path)
+        if gpgme is None:
+            try:
+                import gpg as gpgme
+            except ImportError:
+                raise OSError('GPGME python bindings are not installed')
+        # contexts cannot be shared between threads
+        self._local = threading.local()
+
+    @property
+    def context(self):
+        if not hasattr(self._local, 'context'):
+            self._local.context = gpgme.Context(armor=False)
+        return self._local.context
+
+    def decrypt(self, path, interactive=True):
+        fname = _entry_file(self.store_path, path)
+        if fname is None:
+            return False, f'Invalid entry path {path}'
+        context = self.context
+        context.pinentry_mode = (gpgme.constants.PINENTRY_MODE_DEFAULT
+                                 if interactive else
+                                 gpgme.constants.PINENTRY_MODE_ERROR)
+        try:
+            with open(fname, 'rb') as fobj:
+                data, _, _ = context.decrypt(fobj, verify=False)
+            return True, SecretEntry(data)
+        except (OSError, gpgme.errors.GPGMEError) as exc:
+            return False, str(exc)
+
+
+BACKENDS = {x.name: x for x in (GpgmeBackend, GpgBackend, PassBackend)}
+
+
+def get_backend(name, store_path):
+    """Return requested decryption backend, or the first one which is
+    available for 'auto'. Falls back to pass command."""
+    names = list(BACKENDS) if name == 'auto' else [name]
+    for name in names:
+        try:
+            return BACKENDS[name](store_path)
+        except KeyError:
+            print(f'Warning: unknown decrypt_backend {name}')
+        except OSError as exc:
+            if len(names) == 1:
+                print(f'Warning: cannot use {name} backend: {exc}')
+    return PassBackend(store_path)
+
+
+def _decrypt_command(args, env=None):
+    """Run decryption command, and return success flag and SecretEntry with
+    its output or error message. Output is read straight into the buffer of
+    the entry, without any intermediate copies."""
+    data = bytearray()
+    chunk = bytearray(4096)
+    try:
+        with subprocess.Popen(args, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, env=env,
+                              bufsize=0) as proc:
+            while True:
+                count = proc.stdout.readinto(chunk)
+                if not count:
+                    break
+                data += memoryview(chunk)[:count]
+            error = proc.stderr.read()
+    except OSError as exc:
+        return False, str(exc)
+    finally:
+        chunk[:] = bytes(len(chunk))
+    if proc.returncode == 0:
+        return True, SecretEntry(data)
+    data[:] = bytes(len(data))
+    return False, error.decode('utf-8', 'replace')
+
+
+def _format_entry(fields):
+    """Return entry text with password, user, url, extra (name, value) pairs
+    and notes fields, in the layout SecretEntry reads"""
+    lines = [fields['password']]
+    notes = [fields['notes']] if fields.get('notes') else []
+    for name in ('user', 'url'):
+        if fields.get(name):
+            lines.append(f'{name}: {" ".join(fields[name].split())}')
+    for name, value in fields.get('extra', []):
+        if '\n' in value.strip():
+            # only notes can span several lines
+            notes.append(f'{name}:\n{value.strip()}')
+        else:
+            lines.append(f'{name}: {value.strip()}')
+    if notes:
+        lines.append('notes: ' + '\n\n'.join(notes))
+    return '\n'.join(lines) + '\n'
+
+
+def _safe_name(name):
+    "Turn the name into a single store path component"
+    name = ' '.join(name.split()).replace(os.sep, '-')
+    if name in ('', '.', '..', '.git'):
+        return '_'
+    return name
+
+
+def _gpg_command():
+    """Return gpg executable and the options pass is using for it"""
+    gpg = shutil.which('gpg2') or shutil.which('gpg')
+    if not gpg:
+        raise OSError('gpg executable not found')
+    options = (os.environ.get('PASSWORD_STORE_GPG_OPTS', '').split() +
+               ['--quiet', '--yes', '--compress-algo=none', '--no-encrypt-to'])
+    if os.environ.get('GPG_AGENT_INFO') or os.path.basename(gpg) == 'gpg2':
+        options += ['--batch', '--use-agent']
+    return gpg, options
+
+
+def _entry_file(store_path, path):
+    """Return file name of the entry, or None if it points outside of the
+    store"""
+    if '..' in path.split('/') or os.path.isabs(path):
+        return None
+    return os.path.join(store_path, path + '.gpg')
+
+
+class Prefetcher:
+    """Decrypt entries which are likely to be viewed next in the background,
+    and put them in the cache for a short time. Prefetching starts only after
+    the first successful decryption, and never asks for the passphrase, so it
+    only works while the key is unlocked in the agent."""
+    def __init__(self, store, workers, ttl):
+        self.store = store
+        self.ttl = ttl
+        self.enabled = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._futures = []
+
+    def prefetch(self, paths):
+        """Replace pending requests with the given paths"""
+        self.cancel()
+        if not self.enabled:
+            return
+        for path in paths:
+            if path not in self.store.cache:
+                self._futures.append(self._executor.submit(self._fetch,
+                                                           path))
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch(self, path):
+        success, data = self.store.decrypt(path, interactive=False)
+        if success:
+            self.store.cache.put(path, data, self.ttl)
+        else:
+            # most likely the key has been locked again
+            self.enabled = False
+
+
+class MetadataIndex:
+    """Searchable user, url and notes fields of all the entries.
+
+    Index is built in the background from entries decrypted without asking
+    for the passphrase, so it starts only after the first successful
+    decryption. It's kept encrypted to the store GPG ids in the cache
+    directory, and only entries modified since then are decrypted again."""
+    VERSION = 1
+    MAX_FAILURES = 3  # in a row, before assuming the key is locked again
+    NOTIFY = 200  # number of entries to index between UI updates
+
+    def __init__(self, store, on_update=None):
+        self.store = store
+        self.on_update = on_update
+        self._entries = {}  # path -> [mtime, lowercase searchable text]
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._again = False
+        self.started = False
+
+    def start(self):
+        """Load the index and bring it up to date in the background. If it
+        is already running, it will go over the store once again."""
+        self.started = True
+        with self._lock:
+            self._again = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+
+    def search(self, query):
+        "Return set of entry paths which fields contain lowercase query"
+        return {path for path, (_, text) in list(self._entries.items())
+                if query in text}
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._again:
+                    self._thread = None
+                    return
+                self._again = False
+            try:
+                if not self._loaded:
+                    self._load()
+                    self._loaded = True
+                if self._update():
+                    self._save()
+            except OSError as exc:
+                print('Warning: There was an error on updating metadata '
+                      'index:', exc)
+
+    def _notify(self):
+        if self.on_update:
+            GLib.idle_add(self.on_update)
+
+    def _update(self):
+        """Index entries which are new or modified since they were indexed,
+        and forget removed ones. Return whether anything has changed."""
+        current = {}
+        for mount, store_path in self.store.stores.items():
+            for root, dirs, files in os.walk(store_path):
+                dirs[:] = [x for x in dirs if x != '.git']
+                for fname in files:
+                    if fname.lower().endswith('.gpg'):
+                        fullpath = os.path.join(root, fname)
+                        path = os.path.join(mount, os.path.relpath(
+                            fullpath, store_path))
+                        try:
+                            current[path[:-4]] = os.stat(
+                                fullpath).st_mtime_ns
+                        except OSError:
+                            pass
+
+        removed = self._entries.keys() - current.keys()
+        for path in removed:
+            del self._entries[path]
+
+        count = failures = 0
+        for path, mtime in sorted(current.items()):
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                continue
+            success, data = self.store.decrypt(path, interactive=False)
+            if not success:
+                failures += 1
+                if failures == self.MAX_FAILURES:
+                    break
+                continue
+            failures = 0
+            self._entries[path] = [mtime, '\n'.join((data['user'],
+                                                     data['url'],
+                                                     data['notes'])).lower()]
+            data.wipe()
+            count += 1
+            if count % self.NOTIFY == 0:
+                self._notify()
+
+        if count or removed:
+            self._notify()
+        return bool(count or removed)
+
+    def _path(self):
+        digest = hashlib.sha1(self.store.identity.encode()).hexdigest()[:16]
+        return os.path.join(XDG_CACHE_DIR, 'gtkpass', f'meta-{digest}.gpg')
+
+    def _load(self):
+        path = self._path()
+        if not os.path.exists(path):
+            return
+        gpg, options = _gpg_command()
+        proc = subprocess.run([gpg, '-d'] + options +
+                              ['--batch', '--pinentry-mode', 'error', path],
+                              capture_output=True)
+        try:
+            index = json.loads(proc.stdout)
+            if (proc.returncode != 0 or index['version'] != self.VERSION or
+                    index['store'] != self.store.identity):
+                return
+            self._entries = index['entries']
+        except (ValueError, TypeError, KeyError):
+            return
+        self._notify()
+
+    def _save(self):
+        """Encrypt the index to the store root GPG ids (of the first store,
+        if there are more of them)"""
+        recipients = self.store.recipients(next(iter(self.store.stores)))
+        if not recipients:
+            return
+        gpg, options = _gpg_command()
+        path = self._path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index = json.dumps({'version': self.VERSION,
+                            'store': self.store.identity,
+                            'entries': self._entries},
+                           separators=(',', ':'))
+        args = [x for recipient in recipients for x in ('-r', recipient)]
+        proc = subprocess.run([gpg, '-e'] + args + options,
+                              input=index.encode(), capture_output=True)
+        if proc.returncode != 0:
+            raise OSError(proc.stderr.decode('utf-8', 'replace').strip())
+        with open(path + '.tmp', 'wb', opener=_private_opener) as fobj:
+            fobj.write(proc.stdout)
+        os.replace(path + '.tmp', path)
+
+
+class PassStore:
     """Password store GUI app"""
-    NON_EMPTY = 1
-    SUCCESS = 0
-    ERROR = 2
+    BATCH_DELAY = 0.05  # s, between batches of streamed directories
+    MOUNTS_MTIME = 0  # root of mounted stores is not a real directory
+    GIT_CHUNK = 500  # paths per git command
 
     def __init__(self):
-        self.store_path = self._get_store_path()
         self.data = Tree()
         self.conf = {}
         self._read_config()
+        # mount name to store directory; single store is not mounted at all,
+        # and its name is empty
+        self.stores = self._get_stores()
+        self.mounted = '' not in self.stores
+        METRICS.enabled = self.conf.get('metrics', False)
+        self.lazy = self.conf.get('lazy_load', False)
+        self.scan_workers = self.conf.get('scan_workers', 8)
+        self.index = SearchIndex()
+        # git heads and directory mtimes of the loaded snapshot, to be checked
+        self._snapshot = None, None
+        name = self.conf.get('decrypt_backend', 'auto')
+        self.backends = {mount: get_backend(name, path)
+                         for mount, path in self.stores.items()}
+        backend = next(iter(self.backends.values()))
+        self.prefetcher = None
+        cache_size = self.conf.get('cache_size', 0)
+        if self.conf.get('prefetch', False):
+            if backend.can_prefetch:
+                self.prefetcher = Prefetcher(self,
+                                             self.conf.get('prefetch_workers',
+                                                           2),
+                                             self.conf.get('prefetch_ttl',
+                                                           30))
+                # prefetched entries needs some place to live
+                cache_size = cache_size or 32
+            else:
+                print(f'Warning: prefetching is not possible with '
+                      f'{backend.name} backend')
+        self.cache = SecretCache(cache_size, self.conf.get('cache_ttl', 60))
+        if self.cache.enabled:
+            GLib.timeout_add_seconds(max(1, self.cache.ttl // 4),
+                                     self._purge_cache)
+        # single worker for each store, so there is at most one gpg/pinentry
+        # round trip running at the time, and slow store (or the one waiting
+        # for the passphrase) doesn't hold up the others
+        self._executors = {mount: concurrent.futures.ThreadPoolExecutor(
+            max_workers=1) for mount in self.stores}
+        # reads lazily loaded directories in the background
+        self._dir_pool = None
+        self._pending = None
+        self._serial = 0
+        self.reencryptor = Reencryptor(self,
+                                       self.conf.get('reencrypt_workers',
+                                                     os.cpu_count()))
+        self.importer = Importer(self, self.conf.get('import_workers',
+                                                     os.cpu_count()))
+        self.metadata = None
+        if self.conf.get('metadata_index', False):
+            if backend.can_prefetch:
+                self.metadata = MetadataIndex(self)
+            else:
+                print(f'Warning: metadata index is not possible with '
+                      f'{backend.name} backend')
 
     def _get_store_path(self):
-        path = os.environ.get('$PASSWORD_STORE_DIR')
+        path = os.environ.get('PASSWORD_STORE_DIR')
         if path:
             _check_pass_store(path)
             return path
@@ -512,75 +2731,608 @@ class PassStore:
         _check_pass_store(path)
         return path
 
+    def _get_stores(self):
+        """Return stores from the configuration, which are mounted under
+        their names, or the default store"""
+        stores = {}
+        for name, path in (self.conf.get('stores') or {}).items():
+            name = str(name)
+            if not name or name in ('.', '..', '.git') or os.sep in name:
+                print(f'Warning: invalid store name {name!r}')
+                continue
+            path = os.path.expanduser(str(path))
+            if not os.path.isdir(path):
+                print(f'Warning: path for store {name} {path!r} either '
+                      f'does not exist or is not a directory')
+                continue
+            stores[name] = path
+        return stores or {'': self._get_store_path()}
+
+    def split(self, path):
+        "Return mount name and path relative to its store"
+        if not self.mounted:
+            return '', path
+        mount, _, path = path.partition(os.sep)
+        return mount, path
+
+    def real_path(self, path):
+        """Return location of the store item on the disk, or None for the
+        root of mounted stores and unknown mounts"""
+        mount, path = self.split(path)
+        if not mount and self.mounted or mount not in self.stores:
+            return None
+        return os.path.join(self.stores[mount], path)
+
+    @METRICS.timed('decrypt')
+    def decrypt(self, path, interactive=True):
+        "Decrypt the entry with the backend of its store"
+        mount, path = self.split(path)
+        if mount not in self.backends:
+            return False, f'There is no store {mount}'
+        return self.backends[mount].decrypt(path, interactive)
+
+    def submit(self, path):
+        """Decrypt path in the worker thread of its store, return the
+        future"""
+        mount = self.split(path)[0]
+        executor = self._executors.get(mount)
+        if executor is None:
+            executor = next(iter(self._executors.values()))
+        return executor.submit(self.get_pass, path)
+
+    @property
+    def identity(self):
+        "String identifying the set of stores, for the cache files"
+        if not self.mounted:
+            return self.stores['']
+        return '\n'.join(f'{x}={y}' for x, y in self.stores.items())
+
+    def git_heads(self):
+        if not self.mounted:
+            return _git_head(self.stores[''])
+        return {x: _git_head(y) for x, y in self.stores.items()}
+
+    @METRICS.timed('gather_pass_tree')
     def gather_pass_tree(self):
+        self.data = self.scan_tree(self.lazy)
+        self.index = SearchIndex()
+        for obj in self.data.children:
+            self.index.add(obj)
+
+    def scan_tree(self, lazy=False):
+        "Read the store into a new Tree"
+        model = Tree()
+        self._gather_pass_tree(model, '', lazy)
+        return model
+
+    def scan_async(self, batch, done):
+        """Read the store into a new, empty data tree in a background thread.
+        Directories are passed to batch(items) on the main loop as soon as
+        they are read, where items are arguments for attach, and the
+        tree to done(data) at the end."""
         self.data = Tree()
-        self._gather_pass_tree(self.data, self.store_path, '')
+        self.index = SearchIndex()
+        root = self.data
+
+        @METRICS.timed('scan')
+        def scan():
+            items = []
+            last = time.monotonic()
+            for item in self._walk(root, '', self.lazy):
+                items.append(item)
+                if time.monotonic() - last > self.BATCH_DELAY:
+                    GLib.idle_add(batch, items)
+                    items = []
+                    last = time.monotonic()
+            GLib.idle_add(batch, items)
+            GLib.idle_add(done, root)
+        threading.Thread(target=scan, daemon=True).start()
 
+    def rescan_async(self, callback):
+        """Read the whole store in a background thread, and pass the new tree
+        to the callback on the main loop. Right after loading the snapshot,
+        nothing is read (nor passed) when the snapshot is up to date."""
+        def scan():
+            if self._snapshot_current():
+                return
+            GLib.idle_add(callback, self.scan_tree())
+        threading.Thread(target=scan, daemon=True).start()
+
+    def merge_tree(self, model, fresh):
+        """Bring the model in line with the freshly scanned tree. Return list
+        of (parent, added, removed) for every changed directory."""
+        if not (model.loaded and fresh.loaded):
+            return []
+        model.mtime = fresh.mtime
+        current = {_node_key(x): x for x in model.children}
+        found = {_node_key(x): x for x in fresh.children}
+
+        removed = [x for key, x in current.items() if key not in found]
+        for obj in removed:
+            model.remove_child(obj)
+            self.index.remove(obj)
+
+        added = []
+        for key in sorted(found.keys() - current.keys()):
+            obj = found[key]
+            model.add_child(obj)
+            self.index.add(obj)
+            added.append(obj)
+
+        changes = [(model, added, removed)] if added or removed else []
+        for key in found.keys() & current.keys():
+            if isinstance(current[key], Tree):
+                changes.extend(self.merge_tree(current[key], found[key]))
+        return changes
+
+    def load_snapshot(self):
+        """Populate the tree from the snapshot. Return None if there is no
+        usable snapshot, otherwise False, as it's not known to be up to date
+        with the store - rescan_async checks it in the background, so that
+        directories are not stat'ed before anything is shown."""
+        if not self.conf.get('tree_snapshot', True):
+            return None
+        try:
+            with open(self._snapshot_path()) as fobj:
+                snapshot = json.load(fobj)
+            if (snapshot['version'] != SNAPSHOT_VERSION or
+                    snapshot['store'] != self.identity):
+                return None
+            data = self._decode_tree(snapshot['tree'])
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+        self.data = data
+        self.index = SearchIndex()
+        for obj in self.data.children:
+            self.index.add(obj)
+        self._snapshot = snapshot.get('head'), self._dir_mtimes(data, '')
+        return False
+
+    def save_snapshot(self):
+        """Store names and paths of the tree (and nothing else) in the cache
+        directory"""
+        if not self.conf.get('tree_snapshot', True):
+            return
+        path = self._snapshot_path()
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'store': self.identity,
+                    'head': self.git_heads(),
+                    'tree': self._encode_tree(self.data)}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w', opener=_private_opener) as fobj:
+                json.dump(snapshot, fobj, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print('Warning: There was an error on saving tree snapshot:', e)
+
+    def _snapshot_path(self):
+        digest = hashlib.sha1(self.identity.encode()).hexdigest()[:16]
+        return os.path.join(XDG_CACHE_DIR, 'gtkpass', f'tree-{digest}.json')
+
+    def _encode_tree(self, model):
+        children = None
+        if model.loaded:
+            children = [self._encode_tree(x) if isinstance(x, Tree)
+                        else x.name for x in model.children]
+        return [model.name, model.mtime, children]
+
+    def _decode_tree(self, item):
+        name, mtime, children = item
+        model = Tree(name, children is not None)
+        model.mtime = mtime
+        for child in children or []:
+            if isinstance(child, str):
+                model.add_child(Leaf(child))
+            else:
+                model.add_child(self._decode_tree(child))
+        return model
+
+    def _dir_mtimes(self, model, path):
+        "Return list of paths and mtimes of the loaded directories"
+        if not model.loaded:
+            return []
+        result = [(path, model.mtime)]
+        for obj in model.children:
+            if isinstance(obj, Tree):
+                result.extend(self._dir_mtimes(
+                    obj, f'{path}/{obj.name}' if path else obj.name))
+        return result
+
+    def _snapshot_current(self):
+        """Return whether just loaded snapshot matches the store. It's
+        checked only once, later calls return False."""
+        head, dirs = self._snapshot
+        self._snapshot = None, None
+        if dirs is None or head != self.git_heads():
+            return False
+        for path, mtime in dirs:
+            if self.mounted and not path:
+                current = self.MOUNTS_MTIME
+            else:
+                try:
+                    current = os.stat(self.real_path(path)).st_mtime_ns
+                except (OSError, TypeError):
+                    return False
+            if current != mtime:
+                return False
+        return True
+
+    def load_dir(self, model):
+        "Read contents of the lazily loaded directory"
+        if model.loaded:
+            return
+        model.loaded = True
+        self._gather_pass_tree(model, model.path, self.lazy)
+        for obj in model.children:
+            self.index.add(obj)
+
+    def load_dir_async(self, model, callback):
+        """Read contents of the lazily loaded directory in the pool of
+        threads, and call callback(model, mtime, children) on the main loop.
+        It's up to the callback to attach the children, unless the directory
+        got loaded in the meantime."""
+        if self._dir_pool is None:
+            self._dir_pool = concurrent.futures.ThreadPoolExecutor(
+                self.scan_workers)
+        path = model.path
+
+        def read():
+            GLib.idle_add(callback, model, *self._read_dir(path, True))
+        self._dir_pool.submit(read)
+
+    @METRICS.timed('get_pass')
     def get_pass(self, path):
-        proc = subprocess.run(['pass', path], capture_output=True,
-                              encoding='utf-8')
-        if proc.returncode == 0:
-            return True, proc.stdout
-        else:
-            return False, proc.stderr
+        data = self.cache.get(path)
+        if data is not None:
+            METRICS.count('cache.hit')
+            return True, data
+
+        METRICS.count('cache.miss')
+        success, data = self.decrypt(path)
+        if not success:
+            METRICS.count('decrypt.error')
+        if success:
+            if self.cache.enabled:
+                # cache wipes its own copy when it drops it
+                self.cache.put(path, data.copy())
+            if self.prefetcher:
+                # key is unlocked in the agent now
+                self.prefetcher.enabled = True
+            if self.metadata and not self.metadata.started:
+                self.metadata.start()
+        return success, data
+
+    def get_pass_async(self, path, callback):
+        """Decrypt path in the worker thread and call callback(path, success,
+        data) on the main loop. Only the latest request is delivered, previous
+        one is either cancelled if not started yet, or its result dropped."""
+        self.cancel_get_pass()
+        serial = self._serial
+        self._pending = self.submit(path)
+        self._pending.add_done_callback(
+            lambda future: GLib.idle_add(self._deliver, serial, path,
+                                         future, callback))
 
+    def cancel_get_pass(self):
+        self._serial += 1
+        if self._pending:
+            self._pending.cancel()
+            self._pending = None
+
+    def close(self):
+        self.cancel_get_pass()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self._dir_pool is not None:
+            self._dir_pool.shutdown(wait=False, cancel_futures=True)
+        if self.prefetcher:
+            self.prefetcher.close()
+        self.reencryptor.cancel()
+        self.importer.cancel()
+        self.cache.clear()
+        # store might not have been even read yet
+        if self.data.mtime is not None:
+            self.save_snapshot()
+
+    def _purge_cache(self):
+        self.cache.purge()
+        return True
+
+    def _deliver(self, serial, path, future, callback):
+        if future.cancelled():
+            return False
+        try:
+            success, data = future.result()
+        except OSError as exc:
+            success, data = False, str(exc)
+        if serial != self._serial:
+            # nobody is waiting for it anymore
+            if success:
+                data.wipe()
+            return False
+        self._pending = None
+        callback(path, success, data)
+        return False
+
+    @METRICS.timed('new_dir')
     def new_dir(self, dirname):
-        path = os.path.join(self.store_path, dirname)
+        path = self.real_path(dirname)
+        if path is None:
+            return False, f'{dirname} is not inside any of the stores'
         try:
             os.mkdir(os.path.join('/root', path), mode=500)
             return True, ''
         except IOError as exc:
             return False, str(exc)
 
-    def delete(self, item, recursively=False):
-        path = os.path.join(self.store_path, item)
+    def is_empty(self, item):
+        try:
+            with os.scandir(self.real_path(item)) as it:
+                return next(it, None) is None
+        except OSError:
+            return True
 
-        if os.path.exists(path) and os.path.isdir(path) and recursively:
-            try:
-                shutil.rmtree(path)
-            except IOError as exc:
-                return self.ERROR, str(exc)
-        elif os.path.exists(path) and os.path.isdir(path):
-            _, files, dirs = next(os.walk(path))
-            if files or dirs:
-                return self.NON_EMPTY, ""
-            try:
-                shutil.rmtree(path)
-            except IOError as exc:
-                return self.ERROR, str(exc)
-        elif not os.path.exists and os.path.isfile(path + '.gpg'):
+    def recipients(self, item):
+        """Return GPG ids from the .gpg-id file which applies to given store
+        directory"""
+        while True:
+            path = self.real_path(item)
+            if path is None:
+                return []
             try:
-                os.unlink(path + '.gpg')
-            except IOError as exc:
-                return self.ERROR, str(exc)
+                with open(os.path.join(path, '.gpg-id')) as fobj:
+                    return [x.split('#')[0].strip() for x in fobj
+                            if x.split('#')[0].strip()]
+            except OSError:
+                if not self.split(item)[1]:
+                    return []
+                item = os.path.dirname(item)
 
-        return self.SUCCESS, ''
+    def batch_delete(self, items, callback):
+        """Remove given store items (entries or whole directories) given as
+        (path, is_leaf) pairs in the background, and record it in a single
+        git commit"""
+        self._batch([(self._remove, path, is_leaf, None)
+                     for path, is_leaf in items],
+                    'Remove {} from store.', callback)
 
-    def _gather_pass_tree(self, model, root, dirname):
-        fullpath = os.path.join(root, dirname)
-        ps_path = fullpath[len(self.store_path)+1:]
+    def batch_move(self, moves, callback):
+        """Move or rename store items given as (source, is_leaf,
+        destination) in the background, and record it in a single git
+        commit. Existing items are never overwritten."""
+        self._batch([(self._move, src, is_leaf, dst)
+                     for src, is_leaf, dst in moves],
+                    'Rename {}.', callback)
 
-        root, dirs, files = next(os.walk(fullpath))
-        for fname in files:
-            if (fname in ['.gitattributes', '.gpg-id'] or
-                    not fname.lower().endswith('.gpg')):
-                continue
-            fname = fname[:-4]  # chop off extension
-            model.children.append(Leaf(fname, os.path.join(ps_path, fname)))
+    def _batch(self, operations, message, callback):
+        """Run operations in a thread, commit the result with message filled
+        with the item (or number of items), and call callback from the main
+        loop with the list of errors and the set of directories which needs
+        to be reconciled. Every store gets its own commit."""
+        def run():
+            errors = []
+            # mount name to done items, removed and added files
+            changes = {}
+            dirnames = set()
+            for func, src, is_leaf, dst in operations:
+                try:
+                    source, target = func(src, is_leaf, dst)
+                except OSError as exc:
+                    errors.append(f'{src}: {exc.strerror or exc}')
+                    continue
+                done, removed, added = changes.setdefault(
+                    self.split(src)[0], ([], [], []))
+                done.append(src if dst is None else f'{src} to {dst}')
+                removed.append(source)
+                if target:
+                    added.append(target)
+                for path in (src, dst or ''):
+                    # all the way up, as move might create new directories
+                    while path:
+                        path = os.path.dirname(path)
+                        dirnames.add(path)
+            for mount, (done, removed, added) in changes.items():
+                if len(done) > 1:
+                    msg = (message.format(f'{len(done)} items') + '\n\n' +
+                           '\n'.join(done))
+                else:
+                    msg = message.format(done[0])
+                error = self.git_commit(mount, removed, added, msg)
+                if error:
+                    errors.append(error)
+            GLib.idle_add(callback, errors, dirnames)
 
-        for dname in dirs:
-            if dname == '.git':
-                continue
-            t = Tree(dname, os.path.join(ps_path, dname))
-            model.children.append(t)
-            self._gather_pass_tree(t, root, dname)
+        threading.Thread(target=run, daemon=True).start()
+
+    def _item_path(self, item, is_leaf):
+        path = None
+        if item and '..' not in item.split(os.sep) and not os.path.isabs(item):
+            path = self.real_path(item)
+        # root of the store (mounted one as well) is not an item
+        if path is None or not self.split(item)[1]:
+            raise OSError(f'invalid path {item!r}')
+        # entry and directory of the same name can live side by side
+        if is_leaf:
+            return path + '.gpg'
+        return path
+
+    @METRICS.timed('delete')
+    def _remove(self, item, is_leaf, _dst):
+        path = self._item_path(item, is_leaf)
+        if is_leaf:
+            os.unlink(path)
+        else:
+            shutil.rmtree(path)
+        self.cache.invalidate(item)
+        return path, None
+
+    @METRICS.timed('move')
+    def _move(self, src, is_leaf, dst):
+        source = self._item_path(src, is_leaf)
+        target = self._item_path(dst, is_leaf)
+        if self.split(src)[0] != self.split(dst)[0]:
+            # it would need re-encryption, and a commit in both stores
+            raise OSError(f'cannot move {src} to another store')
+        if os.path.lexists(target):
+            raise OSError(f'{dst} already exists')
+        if (target + os.sep).startswith(source + os.sep):
+            raise OSError(f'cannot move {src} into itself')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(source, target)
+        self.cache.invalidate(src)
+        return source, target
+
+    @METRICS.timed('git_commit')
+    def git_commit(self, mount, removed, added, message):
+        """Record removed and added files in the git repository of the store
+        mounted as mount, and commit them. Return error message, or None on
+        success or when store is not a git repository."""
+        store_path = self.stores[mount]
+        if not os.path.isdir(os.path.join(store_path, '.git')):
+            return None
+        git = ['git', '-C', store_path]
+        steps = []
+        # in chunks, so that thousands of paths fit in the command line
+        for start in range(0, len(removed), self.GIT_CHUNK):
+            steps.append(git + ['rm', '-r', '-q', '--cached',
+                                '--ignore-unmatch', '--'] +
+                         removed[start:start + self.GIT_CHUNK])
+        for start in range(0, len(added), self.GIT_CHUNK):
+            steps.append(git + ['add', '--'] +
+                         added[start:start + self.GIT_CHUNK])
+        env = dict(os.environ, LC_ALL='C')
+        try:
+            for cmd in steps:
+                proc = subprocess.run(cmd, capture_output=True, env=env)
+                if proc.returncode != 0:
+                    break
+            else:
+                # only untracked files (or empty directories) were touched
+                if subprocess.run(git + ['diff', '--cached', '--quiet'],
+                                  env=env).returncode == 0:
+                    return None
+                proc = subprocess.run(git + ['commit', '-q', '-m', message],
+                                      capture_output=True, env=env)
+        except OSError as exc:
+            return f'git: {exc}'
+        if proc.returncode != 0:
+            return (f'git{f" ({mount})" if mount else ""}: '
+                    f'{proc.stderr.decode("utf-8", "replace").strip()}')
+        return None
+
+    def reconcile_dir(self, model):
+        """Synchronize direct children of the model with the directory on the
+        disk. New subdirectories are gathered as a whole, unless lazy loading
+        is enabled. Return lists of added and removed nodes."""
+        if not model.loaded:
+            return [], []
+        leafs, dirs, model.mtime = self._scan_dir(model.path)
+        current = {(isinstance(x, Leaf), x.name): x for x in model.children}
+        found = {(True, x) for x in leafs} | {(False, x) for x in dirs}
+
+        removed = [x for key, x in current.items() if key not in found]
+        for obj in removed:
+            model.remove_child(obj)
+            self.index.remove(obj)
+
+        added = []
+        for is_leaf, name in sorted(found - current.keys()):
+            obj = Leaf(name) if is_leaf else Tree(name, not self.lazy)
+            model.add_child(obj)
+            if is_leaf:
+                self.cache.invalidate(obj.path)
+            elif obj.loaded:
+                self._gather_pass_tree(obj, obj.path, self.lazy)
+            self.index.add(obj)
+            added.append(obj)
+        return added, removed
+
+    @METRICS.timed('scan_dir')
+    def _scan_dir(self, ps_path):
+        """Return entry and directory names found in ps_path, and its
+        modification time"""
+        if self.mounted and not ps_path:
+            # mounted stores, read concurrently as any other directory
+            return [], list(self.stores), self.MOUNTS_MTIME
+        fullpath = self.real_path(ps_path)
+        if fullpath is None:
+            return [], [], None
+        leafs = []
+        dirs = []
+        try:
+            # stat goes first, so that changes made during listing will
+            # invalidate the snapshot
+            mtime = os.stat(fullpath).st_mtime_ns
+            with os.scandir(fullpath) as entries:
+                for entry in entries:
+                    # type comes from the directory listing itself, there is
+                    # no stat call for most of the file systems
+                    if entry.is_dir():
+                        if entry.name != '.git':
+                            dirs.append(entry.name)
+                    elif entry.name[-4:].lower() == '.gpg':
+                        leafs.append(entry.name[:-4])  # chop off extension
+        except OSError:
+            return [], [], None
+        return leafs, dirs, mtime
+
+    def _walk(self, model, ps_path, lazy=False):
+        """Read directory of the model, and unless lazy, all of its
+        subdirectories, sibling subtrees concurrently in the pool of threads.
+
+        Yield (tree, mtime, children) for every directory read, parents
+        before their children. New nodes are not attached to their trees,
+        so that it's up to the caller in which thread it happens."""
+        if lazy:
+            # just the one directory, there is nothing to read concurrently
+            yield (model, *self._read_dir(ps_path, lazy))
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.scan_workers) as pool:
+            futures = {pool.submit(self._scan_dir, ps_path): (model, ps_path)}
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    tree, path = futures.pop(future)
+                    leafs, dirs, mtime = future.result()
+                    children = [Leaf(x) for x in leafs]
+                    for dname in dirs:
+                        t = Tree(dname, not lazy)
+                        children.append(t)
+                        if t.loaded:
+                            subpath = os.path.join(path, dname)
+                            futures[pool.submit(self._scan_dir,
+                                                subpath)] = (t, subpath)
+                    yield tree, mtime, children
+
+    def _read_dir(self, ps_path, lazy):
+        "Return modification time and new nodes of the directory"
+        leafs, dirs, mtime = self._scan_dir(ps_path)
+        return mtime, ([Leaf(x) for x in leafs] +
+                       [Tree(x, not lazy) for x in dirs])
+
+    def _gather_pass_tree(self, model, ps_path, lazy=False):
+        for tree, mtime, children in self._walk(model, ps_path, lazy):
+            self.attach(tree, mtime, children, index=False)
+
+    def attach(self, tree, mtime, children, index=True):
+        "Attach nodes read by _walk to their tree"
+        tree.mtime = mtime
+        for obj in children:
+            tree.add_child(obj)
+            if index:
+                self.index.add(obj)
 
     def _read_config(self):
         conf = os.path.join(XDG_CONF_DIR, 'gtkpass.yaml')
 
         try:
             with open(conf) as fobj:
-                self.conf = yaml.safe_load(fobj)
+                import yaml
+                self.conf = yaml.load(fobj, Loader=getattr(yaml, 'CSafeLoader',
+                                                           yaml.SafeLoader))
         except OSError as e:
             print('Warning: There was an error on loading configuration '
                   'file:', e)
@@ -591,6 +3343,7 @@ class PassStore:
 
         try:
             with open(conf, 'w') as fobj:
+                import yaml
                 yaml.safe_dump(self.conf, fobj)
         except OSError as e:
             print('Warning: There was an error on loading configuration '
@@ -598,6 +3351,895 @@ class PassStore:
             pass
 
 
+class StoreWatcher:
+    """Watch directories of the password store, and report changed ones in
+    batches, so that storm of events (like during git merge) end up as a
+    single update"""
+    EVENTS = (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED,
+              Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.MOVED_OUT,
+              Gio.FileMonitorEvent.RENAMED,
+              Gio.FileMonitorEvent.CHANGES_DONE_HINT)
+    DELAY = 200  # ms
+    MAX_DELAY = 2000  # ms
+
+    def __init__(self, store, callback):
+        self.store = store
+        self.callback = callback
+        self._monitors = {}
+        self._dirty = set()
+        self._timeout = None
+        self._first_event = None
+        self._held = False
+
+    def watch(self, model):
+        if not isinstance(model, Tree) or not model.loaded:
+            return
+        path = self.store.real_path(model.path)
+        if path is not None and model.path not in self._monitors:
+            gfile = Gio.File.new_for_path(path)
+            try:
+                monitor = gfile.monitor_directory(
+                    Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as exc:
+                print(f'Warning: cannot watch {gfile.get_path()}: '
+                      f'{exc.message}')
+                return
+            monitor.connect('changed', self.on_changed, model.path)
+            self._monitors[model.path] = monitor
+        for child in model.children:
+            self.watch(child)
+
+    def unwatch(self, model):
+        if not isinstance(model, Tree):
+            return
+        monitor = self._monitors.pop(model.path, None)
+        if monitor:
+            monitor.cancel()
+        for child in model.children:
+            self.unwatch(child)
+
+    def on_changed(self, monitor, gfile, other_file, event, dirname):
+        name = gfile.get_basename()
+        if name.lower().endswith('.gpg'):
+            # content of the entry might have been changed
+            self.store.cache.invalidate(os.path.join(dirname, name[:-4]))
+        if event not in self.EVENTS:
+            return
+
+        self._dirty.add(dirname)
+        now = time.monotonic()
+        if self._timeout is None:
+            self._first_event = now
+        elif (now - self._first_event) * 1000 < self.MAX_DELAY:
+            GLib.source_remove(self._timeout)
+        else:
+            return
+        self._timeout = GLib.timeout_add(self.DELAY, self._flush)
+
+    def hold(self):
+        "Keep collecting changed directories, but don't report them"
+        self._held = True
+
+    def release(self):
+        "Stop holding changes back, and return directories changed meanwhile"
+        self._held = False
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def _flush(self):
+        self._timeout = None
+        if self._held:
+            return False
+        dirty, self._dirty = self._dirty, set()
+        self.callback(dirty)
+        return False
+
+
+@functools.lru_cache(maxsize=64)
+def _fuzzy_pattern(query, multiline=False):
+    """Compile regex matching query as subsequence, with every character in
+    its own group. Each gap excludes the next character, so that matching
+    never backtracks."""
+    nl = '\\n' if multiline else ''
+    return re.compile(('^' if multiline else '') +
+                      ''.join(f'[^{nl}{x}]*({x})'
+                              for x in map(re.escape, query)),
+                      re.M if multiline else 0)
+
+
+def _fuzzy_score(path, regs, basename):
+    """Score the match similarly to fzf - reward consecutive characters and
+    characters on the word boundaries, penalize gaps"""
+    score = 0
+    prev = -1
+    for pos, _ in regs[1:]:
+        score += 16
+        if pos == prev + 1:
+            score += 8
+        elif prev >= 0:
+            score -= min(pos - prev - 1, 10)
+        if pos == 0 or path[pos - 1] in '/-_. @':
+            score += 10
+        if pos >= basename:
+            score += 2
+        prev = pos
+    return score
+
+
+class GitSync:
+    """Pull or push the store git repository in a background thread,
+    reporting progress and list of changed files back on the main loop"""
+    PULL = 'pull'
+    PUSH = 'push'
+    COMMANDS = {PULL: ['pull', '--rebase', '--progress'],
+                PUSH: ['push', '--progress']}
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._proc = None
+        self._cancelled = False
+
+    @property
+    def running(self):
+        return self._proc is not None
+
+    def run(self, command, progress, done):
+        """Run the command. progress(line) is called for every line git
+        reports, and done(success, message, changed_paths) at the end."""
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0', LC_ALL='C')
+        self._cancelled = False
+        self._proc = subprocess.Popen(['git', '-C', self.store_path] +
+                                      self.COMMANDS[command],
+                                      stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE, env=env)
+        threading.Thread(target=self._run, args=(command, progress, done),
+                         daemon=True).start()
+
+    def cancel(self):
+        if self._proc is not None:
+            self._cancelled = True
+            self._proc.terminate()
+
+    def _run(self, command, progress, done):
+        old_head = _git_head(self.store_path)
+        proc = self._proc
+        lines = []
+        buf = b''
+        for chunk in iter(lambda: proc.stderr.read1(4096), b''):
+            # git progress is updated in place with carriage returns
+            *new, buf = re.split(b'[\r\n]', buf + chunk)
+            new = [x.decode('utf-8', 'replace').strip() for x in new
+                   if x.strip()]
+            if new:
+                lines.extend(new)
+                GLib.idle_add(progress, new[-1])
+        if buf.strip():
+            lines.append(buf.decode('utf-8', 'replace'))
+        proc.wait()
+
+        changed = []
+        new_head = _git_head(self.store_path)
+        if command == self.PULL and old_head and new_head != old_head:
+            diff = subprocess.run(['git', '-C', self.store_path, 'diff',
+                                   '--name-only', '-z', old_head, new_head],
+                                  capture_output=True)
+            changed = [x.decode('utf-8', 'surrogateescape')
+                       for x in diff.stdout.split(b'\0') if x]
+
+        if self._cancelled:
+            success, msg = False, f'git {command} was cancelled'
+        elif proc.returncode:
+            success, msg = False, '\n'.join(lines[-10:])
+        else:
+            success, msg = True, f'git {command} finished'
+        GLib.idle_add(self._done, done, success, msg, changed)
+
+    def _done(self, done, success, msg, changed):
+        self._proc = None
+        done(success, msg, changed)
+        return False
+
+
+class Reencryptor:
+    """Re-encrypt all the entries below store directory to the new set of
+    recipients, like `pass init -p` does, but with a pool of workers.
+
+    Entries which are already encrypted to the recipients are skipped, so
+    interrupted run can be just started again. Subdirectories with their own
+    .gpg-id are left alone."""
+
+    def __init__(self, store, workers):
+        self.store = store
+        self.workers = workers
+        self._thread = None
+        self._cancelled = False
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def run(self, subdir, recipients, progress, done):
+        """Start re-encryption. progress(count, total) is called while files
+        are processed, done(success, message) at the end."""
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(subdir, recipients, progress,
+                                              done), daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _run(self, subdir, recipients, progress, done):
+        try:
+            self.gpg, self.options = _gpg_command()
+            success, msg = self._reencrypt(subdir, recipients, progress)
+        except OSError as exc:
+            success, msg = False, str(exc)
+        GLib.idle_add(self._done, done, success, msg)
+
+    def _done(self, done, success, msg):
+        self._thread = None
+        done(success, msg)
+        return False
+
+    def _reencrypt(self, subdir, recipients, progress):
+        path = self.store.real_path(subdir)
+        if path is None:
+            return False, 'Select the store to re-encrypt'
+        self._subdir = subdir
+        self._path = path
+        keys = self.encryption_keys(recipients)
+        if not keys:
+            return False, (f'No usable encryption key for '
+                           f'{" ".join(recipients)}')
+
+        # recipients are set first, so that entries added in the meantime
+        # are encrypted to the new ones as well
+        gpg_id = os.path.join(path, '.gpg-id')
+        with open(gpg_id + '.tmp', 'w') as fobj:
+            fobj.write('\n'.join(recipients) + '\n')
+        os.replace(gpg_id + '.tmp', gpg_id)
+
+        files = []
+        for root, dirs, fnames in os.walk(path):
+            dirs[:] = [x for x in dirs if x != '.git' and not
+                       os.path.exists(os.path.join(root, x, '.gpg-id'))]
+            files.extend(os.path.join(root, x) for x in fnames
+                         if x.lower().endswith('.gpg'))
+
+        errors = []
+        count = 0
+        last = 0
+
+        def report():
+            nonlocal last
+            if time.monotonic() - last > 0.1 or count == len(files):
+                last = time.monotonic()
+                GLib.idle_add(progress, count, len(files))
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            # entries already encrypted to the recipients are left out, so
+            # that the passphrase is asked for on the first one which really
+            # needs to be decrypted, also on the resumed run
+            stale = []
+            for fname, needed in zip(files, pool.map(
+                    functools.partial(self._is_stale, keys), files)):
+                if needed:
+                    stale.append(fname)
+                else:
+                    count += 1
+                    report()
+            skipped = count
+
+            # first entry might need the passphrase, the rest is then only
+            # using the key unlocked in the agent
+            results = iter([self._reencrypt_file(x, recipients, True)
+                            for x in stale[:1]])
+            futures = [pool.submit(self._reencrypt_file, x, recipients,
+                                   False) for x in stale[1:]]
+            results = itertools.chain(results, (
+                x.result() for x in concurrent.futures.as_completed(futures)))
+            for error in results:
+                count += 1
+                if count == skipped + 1 and error:
+                    # most likely there is no access to the key at all
+                    self._cancelled = True
+                    return False, error
+                if error:
+                    errors.append(error)
+                report()
+
+        if self._cancelled:
+            return False, 'Re-encryption cancelled, start it again to resume'
+        if errors:
+            return False, '\n'.join(errors)
+
+        mount, commit = self.store.split(subdir)
+        commit = os.path.join(commit, '') if commit else ''
+        error = self.store.git_commit(mount, [], [path],
+                                      f'Reencrypt password store using new '
+                                      f'GPG id {", ".join(recipients)}'
+                                      f'{f" ({commit})" if commit else ""}.')
+        if error:
+            return False, error
+        return True, (f'{len(files) - skipped} entries re-encrypted, '
+                      f'{skipped} already up to date')
+
+    def _is_stale(self, keys, fname):
+        """Return True if the file is not encrypted to exactly the primary
+        keys of keys, a mapping of encryption (sub)key ids to them"""
+        if self._cancelled:
+            return True
+        try:
+            encrypted_to = self.recipients_of(fname)
+        except OSError:
+            return True
+        # any of the subkeys of the recipient will do
+        return ({keys.get(x, x) for x in encrypted_to} !=
+                set(keys.values()))
+
+    def _reencrypt_file(self, fname, recipients, interactive):
+        """Return '' when file was re-encrypted, or error message"""
+        if self._cancelled:
+            return 'cancelled'
+        entry = os.path.join(self._subdir, os.path.relpath(fname,
+                                                           self._path))
+        options = self.options
+        if not interactive:
+            options = options + ['--batch', '--pinentry-mode', 'error']
+        try:
+            proc = subprocess.run([self.gpg, '-d'] + options + [fname],
+                                  capture_output=True)
+            if proc.returncode != 0:
+                return f'{entry}: {proc.stderr.decode("utf-8", "replace")}'
+            # write next to the entry and rename it over, so that the entry
+            # is never half written
+            tmp = fname + '.tmp'
+            args = [x for recipient in recipients for x in ('-r', recipient)]
+            enc = subprocess.run([self.gpg, '-e'] + args + ['-o', tmp] +
+                                 self.options, input=proc.stdout,
+                                 capture_output=True)
+            if enc.returncode != 0:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                return f'{entry}: {enc.stderr.decode("utf-8", "replace")}'
+            os.replace(tmp, fname)
+        except OSError as exc:
+            return f'{entry}: {exc}'
+        return ''
+
+    def encryption_keys(self, recipients):
+        """Return mapping of valid encryption (sub)key ids of recipients to
+        the ids of their primary keys. gpg encrypts to a single one of them
+        for each recipient."""
+        proc = subprocess.run([self.gpg, '--list-keys', '--with-colons',
+                               '--'] + recipients, capture_output=True,
+                              encoding='utf-8', errors='replace')
+        keys = {}
+        primary = None
+        for line in proc.stdout.splitlines():
+            fields = line.split(':')
+            if len(fields) <= 11 or fields[0] not in ('pub', 'sub'):
+                continue
+            valid = fields[1] not in ('i', 'd', 'r', 'e')
+            if fields[0] == 'pub':
+                primary = fields[4] if valid else None
+            if primary and valid and 'e' in fields[11]:
+                keys[fields[4]] = primary
+        return keys
+
+    def recipients_of(self, fname):
+        "Return set of key ids the file is encrypted to"
+        proc = subprocess.run([self.gpg, '--list-only', '--batch',
+                               '--status-fd', '1', '--decrypt', fname],
+                              capture_output=True, encoding='utf-8',
+                              errors='replace')
+        return {x.split()[2] for x in proc.stdout.splitlines()
+                if x.startswith('[GNUPG:] ENC_TO ')}
+
+
+class Importer:
+    """Import entries exported from other password managers - CSV, or
+    KeePass 2.x XML - into the store directory. The export is read as a
+    stream, and entries are encrypted by a pool of gpg processes.
+
+    Existing entries are never overwritten, they are skipped instead, so that
+    interrupted import can be just started again. Everything written is
+    committed at once."""
+    # lowercase CSV columns used by the common exports
+    COLUMNS = {'group': ('group', 'folder', 'grouping'),
+               'title': ('title', 'name', 'account'),
+               'password': ('password', 'login_password'),
+               'user': ('username', 'user name', 'user', 'login',
+                        'login_username', 'email'),
+               'url': ('url', 'web site', 'website', 'login_uri', 'uri'),
+               'notes': ('notes', 'note', 'comments', 'extra')}
+    # KeePass string fields
+    KEEPASS = {'Title': 'title', 'Password': 'password', 'UserName': 'user',
+               'URL': 'url', 'Notes': 'notes'}
+    RECYCLE_BIN = 'Recycle Bin'
+
+    def __init__(self, store, workers):
+        self.store = store
+        self.workers = workers
+        self._thread = None
+        self._cancelled = False
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def run(self, fname, target, progress, done):
+        """Start importing fname into the target directory. progress(count)
+        is called while entries are written, done(success, message,
+        dirnames) at the end, with directories which got new entries."""
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(fname, target, progress,
+                                              done), daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _run(self, fname, target, progress, done):
+        dirnames = set()
+        try:
+            self.gpg, self.options = _gpg_command()
+            success, msg = self._import(fname, target, progress, dirnames)
+        except OSError as exc:
+            success, msg = False, str(exc)
+        except Exception as exc:
+            # done has to be called anyway, or the window stays busy
+            success, msg = False, f'Import failed: {exc!r}'
+        GLib.idle_add(self._done, done, success, msg, dirnames)
+
+    def _done(self, done, success, msg, dirnames):
+        self._thread = None
+        done(success, msg, dirnames)
+        return False
+
+    def _import(self, fname, target, progress, dirnames):
+        import csv
+        if self.store.real_path(target) is None:
+            return False, 'Select the store to import into'
+        if fname.lower().endswith('.xml'):
+            entries = self._read_keepass(fname)
+        else:
+            entries = self._read_csv(fname)
+
+        errors = []
+        added = []
+        skipped = 0
+        seen = set()
+        recipients = {}
+        last = 0
+
+        def collect(futures):
+            nonlocal skipped, last
+            for future in futures:
+                path, fname, error = future.result()
+                if error:
+                    errors.append(f'{path}: {error}')
+                elif fname is None:
+                    skipped += 1
+                else:
+                    added.append(fname)
+                    while path:
+                        path = os.path.dirname(path)
+                        dirnames.add(path)
+            if time.monotonic() - last > 0.1:
+                last = time.monotonic()
+                GLib.idle_add(progress, len(added))
+
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                for path, fields in entries:
+                    if self._cancelled:
+                        break
+                    path = self._unique(os.path.join(target, path), seen)
+                    dirname = os.path.dirname(path)
+                    if dirname not in recipients:
+                        recipients[dirname] = self.store.recipients(dirname)
+                    if '\n' in fields['password']:
+                        errors.append(f'{path}: password has several lines')
+                        continue
+                    pending.add(pool.submit(self._write, path,
+                                            _format_entry(fields),
+                                            recipients[dirname]))
+                    # don't keep more of the secrets in memory than needed
+                    if len(pending) >= self.workers * 2:
+                        done, pending = concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        collect(done)
+            except (csv.Error, ValueError, SyntaxError) as exc:
+                # SyntaxError is the base of ElementTree.ParseError
+                errors.insert(0, f'Cannot read {fname}: {exc}')
+            collect(concurrent.futures.as_completed(pending))
+
+        if added:
+            # whatever was written gets committed, even on errors
+            error = self.store.git_commit(
+                self.store.split(target)[0], [], added,
+                f'Import {len(added)} entries from '
+                f'{os.path.basename(fname)}'
+                f'{f" into {target}" if target else ""}.')
+            if error:
+                errors.append(error)
+        GLib.idle_add(progress, len(added))
+
+        if self._cancelled:
+            return False, (f'Import cancelled after {len(added)} entries, '
+                           f'start it again to resume')
+        if errors:
+            return False, '\n'.join(errors[:20])
+        return True, (f'{len(added)} entries imported, {skipped} already '
+                      f'existing')
+
+    def _unique(self, path, seen):
+        "Number entries of the same name within the import"
+        name = path
+        count = 1
+        while name in seen:
+            count += 1
+            name = f'{path}-{count}'
+        seen.add(name)
+        return name
+
+    def _write(self, path, text, recipients):
+        """Encrypt the entry next to its place, and rename it there. Return
+        the path, file name or None if the entry already exists, and error
+        message."""
+        if self._cancelled:
+            return path, None, 'cancelled'
+        if not recipients:
+            return path, None, 'there is no .gpg-id for it'
+        fname = self.store.real_path(path) + '.gpg'
+        if os.path.lexists(fname):
+            return path, None, None
+        tmp = fname + '.tmp'
+        args = [x for recipient in recipients for x in ('-r', recipient)]
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            proc = subprocess.run([self.gpg, '-e'] + args + ['-o', tmp] +
+                                  self.options, input=text.encode('utf-8'),
+                                  capture_output=True)
+            if proc.returncode != 0:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                return path, None, proc.stderr.decode('utf-8',
+                                                      'replace').strip()
+            if os.path.lexists(fname):
+                os.unlink(tmp)
+                return path, None, None
+            os.replace(tmp, fname)
+        except OSError as exc:
+            return path, None, str(exc)
+        return path, fname, None
+
+    def _read_csv(self, fname):
+        "Yield store paths and fields of the entries in the CSV file"
+        import csv
+        with open(fname, newline='', encoding='utf-8-sig') as fobj:
+            reader = csv.reader(fobj)
+            header = [x.strip().lower() for x in next(reader, [])]
+            columns = {}
+            for field, names in self.COLUMNS.items():
+                for name in names:
+                    if name in header:
+                        columns[field] = header.index(name)
+                        break
+            if 'password' not in columns:
+                raise ValueError('there is no password column')
+            extra = [(x, header[x]) for x in range(len(header))
+                     if x not in columns.values() and header[x]]
+            for row in reader:
+                row += [''] * (len(header) - len(row))
+                fields = {x: row[y] for x, y in columns.items()}
+                fields['extra'] = [(name, row[x]) for x, name in extra
+                                   if row[x]]
+                group = fields.pop('group', '').replace('\\', '/')
+                groups = group.split('/')
+                if groups[0] == 'Root':
+                    # KeePassXC puts everything in the Root group
+                    groups = groups[1:]
+                yield self._entry_path(groups, fields), fields
+
+    def _read_keepass(self, fname):
+        """Yield store paths and fields of the entries in KeePass XML export,
+        skipping history and the recycle bin"""
+        from xml.etree import ElementTree
+        stack = []
+        # names of the groups, the root one first
+        groups = []
+        for event, elem in ElementTree.iterparse(fname, ('start', 'end')):
+            if event == 'start':
+                stack.append(elem.tag)
+                if elem.tag == 'Group':
+                    groups.append('')
+                continue
+            stack.pop()
+            if elem.tag == 'Name' and stack and stack[-1] == 'Group':
+                groups[-1] = elem.text or ''
+            elif elem.tag == 'Group':
+                groups.pop()
+                elem.clear()
+            elif (elem.tag == 'Entry' and 'History' not in stack and
+                    self.RECYCLE_BIN not in groups):
+                fields = {'title': '', 'password': '', 'user': '', 'url': '',
+                          'notes': '', 'extra': []}
+                for string in elem.iterfind('String'):
+                    key = string.findtext('Key') or ''
+                    value = string.findtext('Value') or ''
+                    if key in self.KEEPASS:
+                        fields[self.KEEPASS[key]] = value
+                    elif value:
+                        fields['extra'].append((key, value))
+                elem.clear()
+                yield self._entry_path(groups[1:], fields), fields
+
+    def _entry_path(self, groups, fields):
+        "Return store path out of the group names and the entry title"
+        title = fields.pop('title', '') or fields.get('url') or 'untitled'
+        names = [x for x in groups if x.strip()] + [title]
+        return os.path.join(*[_safe_name(x) for x in names])
+
+
+class Daemon:
+    """Keep the store tree, search index and caches in memory without any
+    window, and answer requests on a Unix socket.
+
+    Requests and responses are single line JSON objects, one request per
+    connection:
+
+        {"cmd": "search", "query": "mail", "limit": 20}
+        {"cmd": "lookup", "path": "web/mail", "field": "password"}
+        {"cmd": "copy", "path": "web/mail", "field": "password"}
+
+    Response has "ok" set to true and "results" (search) or "value"
+    (lookup), or "ok" set to false and the "error" message."""
+    FIELDS = ENTRY_FIELDS
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.passs = PassStore()
+        self.conf = self.passs.conf
+        # there is no expanding in the daemon, so everything is read
+        self.passs.lazy = False
+        up_to_date = self.passs.load_snapshot()
+        if up_to_date is None:
+            self.passs.gather_pass_tree()
+            self.passs.save_snapshot()
+        else:
+            self._load_all(self.passs.data)
+        if up_to_date is False:
+            self.passs.rescan_async(self.on_rescanned)
+        self._fuzzy = self.conf.get('search_mode') == 'fuzzy'
+
+        try:
+            self.clipboard = CommandClipboard(self.conf.get(
+                'clipboard_timeout', 45))
+        except OSError as exc:
+            print(f'Warning: copying is not possible: {exc}')
+            self.clipboard = None
+
+        self.watcher = None
+        if self.conf.get('watch_store', True):
+            self.watcher = StoreWatcher(self.passs, self.on_store_changed)
+            self.watcher.watch(self.passs.data)
+
+        self.socket = self._listen()
+        GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN, self.on_connect)
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            # nobody is listening, so it is a leftover
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        else:
+            sock.close()
+            raise OSError(f'daemon is already running on {self.socket_path}')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        return sock
+
+    def _load_all(self, model):
+        "Read directories which were not loaded in the snapshot"
+        self.passs.load_dir(model)
+        for obj in model.children:
+            if isinstance(obj, Tree):
+                self._load_all(obj)
+
+    def run(self):
+        loop = GLib.MainLoop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, loop.quit)
+        try:
+            loop.run()
+        finally:
+            self.close()
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self.clipboard:
+            self.clipboard.clear(wait=True)
+        self.passs.close()
+
+    def on_store_changed(self, dirnames):
+        for dirname in sorted(dirnames, key=lambda x: x.count(os.sep)):
+            tree = self.passs.data.find(dirname)
+            if tree is None:
+                continue
+            self._watch_changes(*self.passs.reconcile_dir(tree))
+        if self.passs.metadata and self.passs.metadata.started:
+            self.passs.metadata.start()
+
+    def on_rescanned(self, fresh):
+        changes = self.passs.merge_tree(self.passs.data, fresh)
+        for _, added, removed in changes:
+            self._watch_changes(added, removed)
+        self.passs.save_snapshot()
+        return False
+
+    def _watch_changes(self, added, removed):
+        if self.watcher is None:
+            return
+        for obj in removed:
+            self.watcher.unwatch(obj)
+        for obj in added:
+            self.watcher.watch(obj)
+
+    def on_connect(self, fd, condition):
+        try:
+            conn, _ = self.socket.accept()
+        except OSError:
+            return True
+        # requests are tiny, so don't let stuck client hold up the daemon
+        conn.settimeout(1)
+        try:
+            with conn.makefile('rb') as fobj:
+                request = json.loads(fobj.readline())
+            self.handle(conn, request)
+        except (OSError, ValueError, TypeError, KeyError) as exc:
+            self.respond(conn, {'ok': False, 'error': str(exc)})
+        return True
+
+    def handle(self, conn, request):
+        cmd = request['cmd']
+        if cmd == 'search':
+            results = self.search(str(request['query']).lower(),
+                                  int(request.get('limit', 20)))
+            self.respond(conn, {'ok': True, 'results': results})
+        elif cmd in ('lookup', 'copy'):
+            field = request.get('field', 'password')
+            if field not in self.FIELDS:
+                raise ValueError(f'unknown field {field}')
+            if cmd == 'copy' and self.clipboard is None:
+                raise ValueError('copying is not available')
+            path = str(request['path'])
+            future = self.passs.submit(path)
+            future.add_done_callback(lambda future: GLib.idle_add(
+                self._on_decrypted, conn, cmd, path, field, future))
+        else:
+            raise ValueError(f'unknown command {cmd}')
+
+    def search(self, query, limit):
+        "Return paths of best limit entries matching the query"
+        index = self.passs.index
+        if not query:
+            return []
+        if self._fuzzy:
+            found = set(index.fuzzy_search(query))
+        else:
+            # entries in matching directories are matching as well
+            found = set()
+            stack = list(index.search(query))
+            while stack:
+                obj = stack.pop()
+                if isinstance(obj, Tree):
+                    stack.extend(obj.children)
+                else:
+                    found.add(obj)
+        if self.passs.metadata and self.passs.metadata.started:
+            entries = index.entries
+            found.update(x for x in (entries.get(y) for y in
+                                     self.passs.metadata.search(query))
+                         if x is not None)
+        found = sorted(found, key=lambda x: len(x.path))
+        return [x.path for x in index.rank(query, found, limit)]
+
+    def _on_decrypted(self, conn, cmd, path, field, future):
+        try:
+            success, data = future.result()
+        except OSError as exc:
+            success, data = False, str(exc)
+        if not success:
+            self.respond(conn, {'ok': False, 'error': data.strip()})
+            return False
+        value = data[field]
+        data.wipe()
+        if cmd == 'lookup':
+            self.respond(conn, {'ok': True, 'value': value})
+            return False
+        try:
+            self.clipboard.copy(value)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            self.respond(conn, {'ok': False, 'error': str(exc)})
+            return False
+        self.respond(conn, {'ok': True})
+        return False
+
+    def respond(self, conn, response):
+        try:
+            conn.sendall(json.dumps(response).encode() + b'\n')
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+def _node_key(node):
+    return isinstance(node, Leaf), node.name
+
+
+def _private_opener(path, flags):
+    return os.open(path, flags, 0o600)
+
+
+def _git_head(path):
+    """Return commit id of the store HEAD, or None if it's not a git
+    repository"""
+    gitdir = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(gitdir, 'HEAD')) as fobj:
+            head = fobj.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[5:]
+        try:
+            with open(os.path.join(gitdir, ref)) as fobj:
+                return fobj.read().strip()
+        except OSError:
+            with open(os.path.join(gitdir, 'packed-refs')) as fobj:
+                for line in fobj:
+                    if line.rstrip().endswith(' ' + ref):
+                        return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+def _run_steps(steps):
+    "Run generator made of steps to the end, and return its result"
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
 def _check_pass_store(path):
     if not os.path.exists(path) or not os.path.isdir(path):
         raise IOError("Path for password store `%s' either doesn't exists or "
@@ -610,16 +4252,50 @@ def quit(app, event):
         app.conf['width'] = dim.width
         app.conf['height'] = dim.height
         app.passs.write_config()
+    app.clipboard.clear(wait=True)
+    app.passs.close()
     Gtk.main_quit(app, event)
 
 
-def main():
-    app = GTKPass()
+def _mark(phase):
+    _STARTUP.append((phase, time.perf_counter()))
+
+
+def _report_startup():
+    "Print time spent in every startup phase so far"
+    for (_, start), (phase, end) in zip(_STARTUP, _STARTUP[1:]):
+        print(f'{phase:<12} {(end - start) * 1000:8.1f} ms', file=sys.stderr)
+    print(f'{"total":<12} {(_STARTUP[-1][1] - _STARTUP[0][1]) * 1000:8.1f} '
+          f'ms', file=sys.stderr)
+
+
+def _watch_metrics():
+    "Dump metrics on SIGUSR1, if they are enabled"
+    if METRICS.enabled:
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1,
+                             METRICS.dump)
+
+
+def main(args=None):
+    if args is None:
+        args = _parse_args()
+
+    if args.daemon:
+        try:
+            daemon = Daemon(args.socket)
+        except OSError as exc:
+            sys.exit(f'Error: {exc}')
+        _watch_metrics()
+        daemon.run()
+        return
+
+    app = GTKPass(profile=args.profile_startup)
     app.connect("delete-event", quit)
 
     GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, quit)
+    _watch_metrics()
     Gtk.main()
 
 
 if __name__ == '__main__':
-    main()
+    main(_ARGS)